@@ -0,0 +1,67 @@
+# Benchmark of the protocol codec
+# Thomas Führinger, 2022, https://github.com/thomasfuhringer/MarkdownPage
+
+"""
+Compares decoding an answer with a page the old way, slicing a copy of every field out of it, with
+protocol.decode_page, which reads the fields through memoryviews, and framing a response by concatenation
+with protocol.frame_parts, which leaves the page where it is for one scatter-gather send, as the server sends the
+responses it does not cache.
+
+python benchmarks/codec.py --page-size 4096 --subpages 200 --repeat 200
+"""
+
+import argparse, os, random, sys, time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+import protocol
+
+def answer_parts(page_size, subpages):
+    page = random.Random(0).randbytes(page_size)
+    subpages_field = protocol.subpages_field([("Subpage {}".format(index), index) for index in range(subpages)])
+    return [b"0", protocol.u32.pack(len(page)), page, protocol.path_field(["Some", "Page"]), subpages_field, bytes(32)]
+
+def decode_by_slicing(answer):
+    page_length = int.from_bytes(answer[1:5], byteorder="big")
+    page = answer[5:page_length + 5]
+    pos = page_length + 5
+    path_length = int.from_bytes(answer[pos:pos + 2], byteorder="big")
+    path = answer[pos + 2:pos + 2 + path_length].decode("utf-8")
+    pos += path_length + 2
+    count = int.from_bytes(answer[pos:pos + 2], byteorder="big")
+    subpages = []
+    pos += 2
+    for index in range(count):
+        length = int.from_bytes(answer[pos:pos + 2], byteorder="big")
+        subpages.append(answer[pos + 2:pos + 2 + length].decode("utf-8"))
+        pos += length + 6
+    return page, path, subpages, bytes(answer[pos:pos + 32])
+
+def frame_by_concatenation(parts):
+    data = b"".join(parts)
+    message = protocol.identifier + protocol.MessageType.Response + data
+    return len(message).to_bytes(4, byteorder="big") + message
+
+def measure(function, argument, repeat):
+    start = time.perf_counter()
+    for index in range(repeat):
+        function(argument)
+    return (time.perf_counter() - start) / repeat
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the protocol codec")
+    parser.add_argument("--page-size", type=int, default=4096, help="KB of the page in the answer")
+    parser.add_argument("--subpages", type=int, default=200)
+    parser.add_argument("--repeat", type=int, default=200)
+    arguments = parser.parse_args()
+
+    parts = answer_parts(arguments.page_size * 1024, arguments.subpages)
+    answer = bytearray(b"".join(parts)) # as it comes from receive_message, without header
+    results = [
+        ("decode by slicing", measure(decode_by_slicing, answer, arguments.repeat)),
+        ("decode_page", measure(protocol.decode_page, answer, arguments.repeat)),
+        ("frame by concatenation", measure(frame_by_concatenation, parts, arguments.repeat)),
+        ("frame_parts", measure(lambda parts: protocol.frame_parts(protocol.MessageType.Response, *parts), parts, arguments.repeat))]
+
+    print("{} KB page, {} subpages, {} repetitions".format(arguments.page_size, arguments.subpages, arguments.repeat))
+    print("{:<24}{:>12}".format("", "ms / answer"))
+    for name, seconds in results:
+        print("{:<24}{:>12.3f}".format(name, seconds * 1000))
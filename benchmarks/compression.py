@@ -0,0 +1,61 @@
+# Benchmark of page archive construction
+# Thomas Führinger, 2022, https://github.com/thomasfuhringer/MarkdownPage
+
+"""
+Compares building page archives the old way, deflating every file, with build_archive,
+which stores files that are already compressed and deflates the rest at the given level.
+The pages are taken from .mdp files or site directories given on the command line.
+
+python benchmarks/compression.py "Lämpel.mdp" Site --repeat 200
+"""
+
+import argparse, io, os, sys, tempfile, time, zipfile
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+import server
+
+def deflate_all(file_path, target):
+    with zipfile.ZipFile(target, "w", zipfile.ZIP_DEFLATED) as zip_file:
+        with os.scandir(file_path) as iterator:
+            for entry in iterator:
+                if entry.is_file():
+                    zip_file.write(os.path.join(file_path, entry.name), entry.name)
+
+def measure(build, directories, repeat):
+    size = 0
+    start = time.perf_counter()
+    for index in range(repeat):
+        for directory in directories:
+            page = io.BytesIO()
+            build(directory, page)
+            size += len(page.getvalue())
+    return (time.perf_counter() - start) / repeat, size // repeat
+
+def page_directories(sources, scratch):
+    directories = []
+    for source in sources:
+        if os.path.isdir(source):
+            directories += [directory for directory, subdirectories, files in os.walk(source)]
+        else: # unpack an .mdp so both methods read the same files
+            directory = os.path.join(scratch, str(len(directories)))
+            with zipfile.ZipFile(source) as archive:
+                archive.extractall(directory)
+            directories.append(directory)
+    return directories
+
+if __name__ == "__main__":
+    base_directory = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+    parser = argparse.ArgumentParser(description="Benchmark page archive construction")
+    parser.add_argument("sources", nargs="*", default=[os.path.join(base_directory, "Lämpel.mdp")], help=".mdp files or site directories")
+    parser.add_argument("--repeat", type=int, default=100)
+    parser.add_argument("--compress-level", type=int, default=server.default_compress_level, choices=range(10))
+    arguments = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as scratch:
+        directories = page_directories(arguments.sources, scratch)
+        before = measure(deflate_all, directories, arguments.repeat)
+        after = measure(lambda directory, page: server.build_archive(directory, page, arguments.compress_level), directories, arguments.repeat)
+
+    print("{} page(s), {} repetitions".format(len(directories), arguments.repeat))
+    print("{:<24}{:>12}{:>12}".format("", "ms / build", "bytes"))
+    print("{:<24}{:>12.3f}{:>12}".format("deflate every file", before[0] * 1000, before[1]))
+    print("{:<24}{:>12.3f}{:>12}".format("per file, level {}".format(arguments.compress_level), after[0] * 1000, after[1]))
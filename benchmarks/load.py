@@ -0,0 +1,194 @@
+# Load benchmark of the page server
+# Thomas Führinger, 2022, https://github.com/thomasfuhringer/MarkdownPage
+
+"""
+Generates a site of the given depth, fan-out and attachment size, starts server.py on it on localhost
+and lets a number of concurrent clients query random pages of it. Throughput and latency percentiles
+are printed and written as JSON, so the results of two versions of the server can be compared.
+Arguments after -- are passed to the server.
+
+python benchmarks/load.py --clients 32 --duration 10 --output before.json -- --asyncio
+"""
+
+import argparse, json, os, random, socket, subprocess, sys, tempfile, threading, time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+import server, protocol
+from protocol import MessageType, ServerBusy
+
+def generate_site(directory, depth, fan_out, attachments, attachment_size, seed=0):
+    """Write a site of fan_out subpages per page down to depth; return the paths of its pages"""
+    generator = random.Random(seed)
+    paths = [""]
+    pending = [""]
+    while pending:
+        path = pending.pop()
+        page_directory = os.path.join(directory, *path.split("/"))
+        os.makedirs(page_directory, exist_ok=True)
+        with open(os.path.join(page_directory, "Text.md"), "w", encoding="utf-8") as file:
+            file.write("# Page {}\n\n".format(path or "Home") + "Some text of the page. " * 200 + "\n")
+        for index in range(attachments):
+            with open(os.path.join(page_directory, "Attachment{}.bin".format(index)), "wb") as file:
+                file.write(generator.randbytes(attachment_size))
+        if path.count("/") + (1 if path else 0) < depth:
+            for index in range(fan_out):
+                subpage = "Page{}".format(index) if path == "" else path + "/Page{}".format(index)
+                paths.append(subpage)
+                pending.append(subpage)
+    return paths
+
+class Client(threading.Thread):
+    """Queries random pages until the deadline, on one kept alive connection or a new one per query"""
+
+    def __init__(self, port, paths, deadline, keep_alive, seed):
+        threading.Thread.__init__(self, daemon=True)
+        self.port = port
+        self.paths = paths
+        self.deadline = deadline
+        self.keep_alive = keep_alive
+        self.random = random.Random(seed)
+        self.latencies = []
+        self.received = 0
+        self.errors = 0
+        self.busy = 0 # connections refused by the server
+
+    def connect(self):
+        connection = socket.create_connection(("localhost", self.port))
+        if self.keep_alive:
+            try:
+                protocol.keep_alive(connection)
+            except ServerBusy:
+                connection.close()
+                raise
+        return connection
+
+    def run(self):
+        connection = None
+        while time.perf_counter() < self.deadline:
+            payload = protocol.encode_query(self.random.choice(self.paths))
+            start = time.perf_counter()
+            try:
+                if connection is None:
+                    connection = self.connect()
+                protocol.send_message(connection, MessageType.Query, payload)
+                answer = receive(connection)
+                if protocol.busy(answer):
+                    raise ServerBusy("Server busy")
+                if answer[3:4] != b"0":
+                    raise ValueError("Page not found")
+            except (OSError, ValueError) as exception:
+                if isinstance(exception, ServerBusy):
+                    self.busy += 1
+                else:
+                    self.errors += 1
+                if connection is not None:
+                    connection.close()
+                connection = None
+                continue
+            self.latencies.append(time.perf_counter() - start)
+            self.received += len(answer) + 4
+            if not self.keep_alive:
+                connection.close()
+                connection = None
+        if connection is not None:
+            connection.close()
+
+def receive(connection):
+    answer = protocol.receive_message(connection)
+    if answer is None:
+        raise ConnectionError("Connection closed")
+    return answer
+
+def percentile(ordered, fraction):
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+def start_server(site, port, server_arguments):
+    process = subprocess.Popen([sys.executable, os.path.realpath(server.__file__), "--site", site, "--port", str(port),
+                                "--search-index", os.path.join(os.path.dirname(site), "Search.pickle")] + server_arguments,
+        stdout=subprocess.DEVNULL)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline: # wait for it to listen
+        if process.poll() is not None:
+            raise RuntimeError("Server exited with code {}".format(process.returncode))
+        try:
+            socket.create_connection(("localhost", port)).close()
+            return process
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError("Server did not start")
+
+def stop_server(process, port):
+    try:
+        connection = socket.create_connection(("localhost", port))
+        protocol.send_message(connection, MessageType.ShutDown)
+        connection.close()
+        process.wait(10)
+    except (OSError, subprocess.TimeoutExpired):
+        process.kill()
+        process.wait()
+
+def run(arguments):
+    with tempfile.TemporaryDirectory() as scratch:
+        site = os.path.join(scratch, "Site")
+        paths = generate_site(site, arguments.depth, arguments.fan_out, arguments.attachments, arguments.attachment_size * 1024)
+        process = start_server(site, arguments.port, arguments.server_arguments)
+        try:
+            for client in [Client(arguments.port, paths, time.perf_counter() + arguments.warm_up, arguments.keep_alive, -index) for index in range(arguments.clients)]:
+                client.start()
+                client.join() # one at a time, to fill caches without measuring
+            start = time.perf_counter()
+            clients = [Client(arguments.port, paths, start + arguments.duration, arguments.keep_alive, index) for index in range(arguments.clients)]
+            for client in clients:
+                client.start()
+            for client in clients:
+                client.join()
+            elapsed = time.perf_counter() - start
+        finally:
+            stop_server(process, arguments.port)
+
+    latencies = sorted(latency for client in clients for latency in client.latencies)
+    milliseconds = lambda seconds: None if seconds is None else round(seconds * 1000, 3)
+    return {
+        "pages": len(paths),
+        "depth": arguments.depth,
+        "fan_out": arguments.fan_out,
+        "attachments": arguments.attachments,
+        "attachment_size_kb": arguments.attachment_size,
+        "clients": arguments.clients,
+        "keep_alive": arguments.keep_alive,
+        "server_arguments": arguments.server_arguments,
+        "duration_s": round(elapsed, 3),
+        "requests": len(latencies),
+        "errors": sum(client.errors for client in clients),
+        "busy": sum(client.busy for client in clients),
+        "requests_per_s": round(len(latencies) / elapsed, 1),
+        "megabytes_per_s": round(sum(client.received for client in clients) / elapsed / 1024 / 1024, 2),
+        "latency_ms": {
+            "mean": milliseconds(sum(latencies) / len(latencies)) if latencies else None,
+            "p50": milliseconds(percentile(latencies, 0.50)),
+            "p95": milliseconds(percentile(latencies, 0.95)),
+            "p99": milliseconds(percentile(latencies, 0.99)),
+            "max": milliseconds(latencies[-1] if latencies else None)}}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the page server under load from concurrent clients")
+    parser.add_argument("--depth", type=int, default=2, help="levels of subpages below the home page")
+    parser.add_argument("--fan-out", type=int, default=5, help="subpages per page")
+    parser.add_argument("--attachments", type=int, default=2, help="attachments per page")
+    parser.add_argument("--attachment-size", type=int, default=64, help="KB per attachment")
+    parser.add_argument("--clients", type=int, default=16, help="concurrent clients")
+    parser.add_argument("--duration", type=float, default=10, help="seconds of measurement")
+    parser.add_argument("--warm-up", type=float, default=0.2, help="seconds each client queries before the measurement")
+    parser.add_argument("--keep-alive", action="store_true", help="query on kept alive connections")
+    parser.add_argument("--port", type=int, default=1551)
+    parser.add_argument("--output", help="file to write the results to as JSON")
+    parser.add_argument("server_arguments", nargs="*", help="passed to server.py, after --")
+    arguments = parser.parse_args()
+
+    results = run(arguments)
+    print(json.dumps(results, indent=2))
+    if arguments.output:
+        with open(arguments.output, "w", encoding="utf-8") as file:
+            json.dump(results, file, indent=2)
@@ -0,0 +1,24 @@
+# Builder of prebuilt Markdown Page archives
+# Thomas Führinger, 2022, https://github.com/thomasfuhringer/MarkdownPage
+
+"""
+Walks the site tree and writes a ready-to-serve archive (Page.mdp) and a manifest with
+the subpages (Page.idx) for every directory into the store, which mirrors the site tree.
+Only pages whose source has changed since the last build are rebuilt.
+
+Serve the store with: python server.py --store Store
+"""
+
+import argparse, time
+import server
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the archives of a Markdown Page site")
+    parser.add_argument("--site", default=server.default_site_path, help="directory with the pages to publish")
+    parser.add_argument("--store", default=server.default_store_path, help="directory to write the archives to")
+    parser.add_argument("--compress-level", type=int, default=server.default_compress_level, choices=range(10), help="zlib level for text and other compressible files")
+    arguments = parser.parse_args()
+
+    start = time.perf_counter()
+    built = server.Store(arguments.site, arguments.store, arguments.compress_level).update()
+    print("Built {} page(s) in {:.2f} s.".format(built, time.perf_counter() - start))
@@ -2,58 +2,653 @@
 # Thomas Führinger, 2022, https://github.com/thomasfuhringer/MarkdownPage
 
 import tymber as ty # https://github.com/thomasfuhringer/tymber
-import pickle, zipfile, os, shutil, pathlib, socket, io, sys, webbrowser
+import pickle, zipfile, os, shutil, socket, io, sys, webbrowser, threading, time, hashlib, urllib.parse, tempfile, concurrent.futures, mmap, zlib
+import protocol
+from protocol import identifier, MessageType, ServerBusy
 
 #default_host = "localhost"
 default_host = "45.76.133.182"
 default_port = 1550
-#identifier = bytes([0x06, 0x0E])
+default_cache_size = 256 * 1024 * 1024 # bytes of visited pages kept on disk
+default_blob_store_size = 256 * 1024 * 1024 # bytes of attachments kept on disk by their hash, shared by all pages
+blob_batch_size = 16 * 1024 * 1024 # bytes of attachments asked for in one message
+copy_chunk_size = 1024 * 1024 # bytes of a file copied from one zip into another at a time
+connect_timeout = 5 # seconds to wait for a server to accept a connection
+read_timeout = 20 # seconds to wait for the next bytes of an answer
+prefetch_workers = 4 # subpages fetched at a time in the background, 0 for none
+prefetch_limit = 32 # subpages of a page fetched in the background at most
+bundle_depth = 2 # levels of pages below the page shown fetched in the background in one bundle
+bundle_limit = 16 * 1024 * 1024 # bytes of pages taken in one bundle at most
 run_code = False
 
-def send(socket, data):
-    length = len(data)
-    socket.send(length.to_bytes(4, byteorder="big"))
-    socket.sendall(data)
+class PageCache(object):
+    """Archives of visited pages on disk with the version the server sent along, evicted least recently used first"""
 
-def receive(socket):
-    length_raw = socket.recv(4)
-    if len(length_raw) != 4:
-        return None
-    length = int.from_bytes(length_raw, byteorder="big")
-    data = bytearray(length)
-    view = memoryview(data)
-    next_offset = 0
-    while length - next_offset > 0:
-        recv_size = socket.recv_into(view[next_offset:], length - next_offset)
-        if recv_size == 0:
+    def __init__(self, directory, size=default_cache_size):
+        self.directory = directory
+        self.size = size
+        self.lock = threading.Lock()
+        self.index_path = os.path.join(directory, "Index.pickle")
+        os.makedirs(directory, exist_ok=True)
+        try:
+            with open(self.index_path, "rb") as file:
+                self.entries = pickle.load(file) # address -> dict(file, path, subpages, version, size, used)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            self.entries = {}
+
+    def get(self, address):
+        with self.lock:
+            entry = self.entries.get(address.casefold())
+            if entry is None:
+                return None
+            if not os.path.exists(entry["file"]):
+                del self.entries[address.casefold()]
+                return None
+            entry["used"] = time.time()
+            return entry
+
+    def temporary_file(self):
+        """Return a new file to receive an archive into, see put"""
+        return tempfile.NamedTemporaryFile(dir=self.directory, suffix=".tmp", delete=False)
+
+    def put(self, address, page, path, subpages, version, blobs=None):
+        """Store the archive of a page, given as bytes or as the name of a temporary file; return its entry.
+        The hashes of attachments also in the blob store may be given as name -> hash."""
+        key = address.casefold()
+        file_name = os.path.join(self.directory, hashlib.sha1(key.encode()).hexdigest() + ".mdp")
+        if isinstance(page, str):
+            os.replace(page, file_name)
+        else:
+            with open(file_name + ".tmp", "wb") as file:
+                file.write(page)
+            os.replace(file_name + ".tmp", file_name)
+        entry = {"file": file_name, "path": path, "subpages": subpages, "version": version, "size": os.path.getsize(file_name), "used": time.time()}
+        if blobs:
+            entry["blobs"] = blobs
+        with self.lock:
+            self.entries[key] = entry
+            used = sum(entry["size"] for entry in self.entries.values())
+            for key, evicted in sorted(self.entries.items(), key=lambda item: item[1]["used"]):
+                if used <= self.size or evicted is entry:
+                    break
+                del self.entries[key]
+                used -= evicted["size"]
+                try:
+                    os.unlink(evicted["file"])
+                except OSError:
+                    pass
+            self.save()
+        return entry
+
+    def hashes(self, entry):
+        """Return the names of the files of a cached page with the hashes of their contents, for a delta query"""
+        if "hashes" not in entry:
+            hashes = {}
+            try:
+                with zipfile.ZipFile(entry["file"]) as archive:
+                    for info in archive.infolist():
+                        if not info.is_dir():
+                            digest = hashlib.sha256()
+                            with archive.open(info) as file:
+                                for block in iter(lambda: file.read(1024 * 1024), b""):
+                                    digest.update(block)
+                            hashes[info.filename] = digest.digest()
+            except (OSError, zipfile.BadZipFile): # the whole page is fetched then
+                return None
+            entry["hashes"] = hashes
+        return entry["hashes"]
+
+    def patch(self, address, entry, delta, removed, path, subpages, version):
+        """Store a page made of a cached one with the files of the delta replaced or added and the removed ones left out;
+        delta is the zip file name or a file object. The files are copied in chunks, none is held in memory whole."""
+        hashes = dict(self.hashes(entry))
+        with self.temporary_file() as target:
+            with zipfile.ZipFile(entry["file"]) as old, zipfile.ZipFile(delta) as changes, zipfile.ZipFile(target, "w") as new:
+                replaced = set(changes.namelist())
+                for info in old.infolist():
+                    if info.filename not in replaced and info.filename not in removed:
+                        with old.open(info) as source, new.open(info, "w") as copy:
+                            shutil.copyfileobj(source, copy, copy_chunk_size)
+                for info in changes.infolist():
+                    digest = hashlib.sha256()
+                    with changes.open(info) as source, new.open(info, "w") as copy:
+                        for chunk in iter(lambda: source.read(copy_chunk_size), b""):
+                            digest.update(chunk)
+                            copy.write(chunk)
+                    hashes[info.filename] = digest.digest()
+        for name in removed:
+            hashes.pop(name, None)
+        blobs = {name: digest for name, digest in entry.get("blobs", {}).items() if name not in replaced and name not in removed}
+        patched = self.put(address, target.name, path, subpages, version, blobs)
+        patched["hashes"] = hashes
+        return patched
+
+    def save(self):
+        with open(self.index_path + ".tmp", "wb") as file:
+            pickle.dump(self.entries, file)
+        os.replace(self.index_path + ".tmp", self.index_path)
+
+class BlobStore(object):
+    """Attachments on disk named by the hash of their content, so that one shared by many pages is fetched once,
+    evicted least recently used first"""
+
+    def __init__(self, directory, size=default_blob_store_size):
+        self.directory = directory
+        self.size = size
+        self.lock = threading.Lock()
+        self.index_path = os.path.join(directory, "Index.pickle")
+        os.makedirs(directory, exist_ok=True)
+        try:
+            with open(self.index_path, "rb") as file:
+                self.entries = pickle.load(file) # hash -> [size, used]
+        except (OSError, EOFError, pickle.UnpicklingError):
+            self.entries = {}
+
+    def get(self, digest):
+        """Return the file name of the attachment with the hash, or None"""
+        file_name = os.path.join(self.directory, digest.hex())
+        with self.lock:
+            entry = self.entries.get(digest)
+            if entry is None:
+                return None
+            if not os.path.exists(file_name):
+                del self.entries[digest]
+                return None
+            entry[1] = time.time()
+        return file_name
+
+    def put(self, digest, data):
+        """Store an attachment unless its content does not match the hash; return whether it was stored"""
+        if hashlib.sha256(data).digest() != digest or len(data) > self.size:
+            return False
+        file_name = os.path.join(self.directory, digest.hex())
+        with open(file_name + ".tmp", "wb") as file:
+            file.write(data)
+        os.replace(file_name + ".tmp", file_name)
+        with self.lock:
+            self.entries[digest] = [len(data), time.time()]
+            used = sum(entry[0] for entry in self.entries.values())
+            for evicted, entry in sorted(self.entries.items(), key=lambda item: item[1][1]):
+                if used <= self.size:
+                    break
+                if evicted == digest:
+                    continue
+                del self.entries[evicted]
+                used -= entry[0]
+                try:
+                    os.unlink(os.path.join(self.directory, evicted.hex()))
+                except OSError:
+                    pass
+            self.save()
+        return True
+
+    def link(self, digest, target):
+        """Make target the attachment with the hash without copying it where the file system allows; return False
+        if it is not in the store"""
+        file_name = self.get(digest)
+        if file_name is None:
+            return False
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        try:
+            os.link(file_name, target)
+        except OSError: # another file system
+            shutil.copyfile(file_name, target)
+        return True
+
+    def save(self):
+        with open(self.index_path + ".tmp", "wb") as file:
+            pickle.dump(self.entries, file)
+        os.replace(self.index_path + ".tmp", self.index_path)
+
+class MappedFile(mmap.mmap):
+    """Memory map which zipfile can read from like from a file"""
+
+    def seekable(self):
+        return True
+
+class Page(object):
+    """An archive opened for viewing, a local file or one in the page cache alike. It is read through a memory map,
+    so neither is copied into memory or to tmp_directory as a whole."""
+
+    def __init__(self, file_name, name, version=None):
+        self.file_name = file_name
+        self.name = name # offered when saving
+        self.version = version
+        self.file = open(file_name, "rb")
+        try:
+            self.map = MappedFile(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            self.archive = zipfile.ZipFile(self.map, mode="r")
+        except (ValueError, OSError, zipfile.BadZipFile): # an empty file cannot be mapped
+            self.close()
+            raise zipfile.BadZipFile("Not a page: " + file_name)
+
+    def save_as(self, file_name):
+        shutil.copyfile(self.file_name, file_name) # copied by the operating system where it can, like sendfile on Linux
+
+    def close(self):
+        if getattr(self, "archive", None) is not None:
+            self.archive.close()
+        if getattr(self, "map", None) is not None:
+            self.map.close()
+        self.file.close()
+
+class ConnectionPool(object):
+    """Sockets kept open per host while the server keeps them alive, so navigation saves the handshake"""
+
+    def __init__(self):
+        self.idle = {} # (host, port) -> [(socket, idle timeout, expiry)]
+        self.persistent = {} # (host, port) -> False once the server has refused to keep connections
+        self.lock = threading.Lock()
+
+    def acquire(self, host, port):
+        """Return an idle socket to the host with its idle timeout, or None"""
+        with self.lock:
+            connections = self.idle.get((host, port), [])
+            while connections:
+                open_socket, idle_timeout, expiry = connections.pop()
+                if time.monotonic() < expiry:
+                    return open_socket, idle_timeout
+                open_socket.close()
+        return None, 0
+
+    def connect(self, host, port, fetch=None):
+        """Open a new socket and ask the server to keep it alive; return it with the idle timeout granted"""
+        if self.persistent.get((host, port), True):
+            open_socket = open_connection(host, port)
+            if fetch is not None and not fetch.attach(open_socket):
+                return open_socket, 0
+            try:
+                idle_timeout = protocol.keep_alive(open_socket)
+            except ServerBusy:
+                open_socket.close()
+                raise
+            if idle_timeout is not None:
+                return open_socket, idle_timeout
+            open_socket.close()
+            if fetch is not None and fetch.cancelled: # broken off, not refused
+                raise InterruptedError("Fetch cancelled")
+            # server does not keep connections
+            self.persistent[(host, port)] = False
+        return open_connection(host, port), 0
+
+    def release(self, host, port, open_socket, idle_timeout):
+        with self.lock:
+            self.idle.setdefault((host, port), []).append((open_socket, idle_timeout, time.monotonic() + idle_timeout - 1))
+
+    def close(self):
+        with self.lock:
+            for connections in self.idle.values():
+                for open_socket, idle_timeout, expiry in connections:
+                    open_socket.close()
+            self.idle.clear()
+
+class Prefetcher(object):
+    """Fetches the pages a user is likely to go to next into the page cache in the background"""
+
+    def __init__(self, workers=prefetch_workers):
+        self.executor = concurrent.futures.ThreadPoolExecutor(workers, thread_name_prefix="prefetch") if workers > 0 else None
+        self.generation = 0 # counts navigations, fetches for an earlier one are dropped
+        self.pending = {} # address casefolded -> future of the fetch, for the current generation
+        self.bundled = set() # addresses casefolded whose future is that of a bundle, for the current generation
+        self.unbundled = set() # hosts which do not send bundles
+        self.lock = threading.Lock()
+
+    def cancel(self):
+        """Drop what was fetched for the previous page"""
+        with self.lock:
+            self.generation += 1
+            for future in self.pending.values():
+                future.cancel() # unless running already
+            self.pending = {}
+            self.bundled = set()
+
+    def prefetch(self, host, addresses, section=None):
+        """Drop what was fetched for the previous page and start fetching addresses. If the address of the page shown
+        is given as section, those of its subpages come in one bundle from servers which send bundles."""
+        if self.executor is None:
+            return
+        self.cancel()
+        with self.lock:
+            bundled = []
+            shown = page_cache.get(section) if section is not None and host not in self.unbundled else None
+            if shown is not None and shown["version"]: # servers which send no versions send no bundles either
+                bundled = [address for address in addresses if address.rpartition("/")[0] == section]
+            if bundled:
+                future = self.executor.submit(self.fetch_bundle, host, section, bundled, self.generation)
+                for address in bundled:
+                    self.pending[address.casefold()] = future
+                    self.bundled.add(address.casefold())
+            for address in addresses:
+                if address not in bundled:
+                    self.pending[address.casefold()] = self.executor.submit(self.fetch, host, address, self.generation)
+
+    def fetch_bundle(self, host, section, addresses, generation):
+        """Return address casefolded -> cache entry of the subpages of the section, fetched in one bundle with the
+        pages below them; those left out of it are fetched one by one"""
+        entries = {}
+        if generation != self.generation:
+            return entries
+        received = bundle(host, section[len(host) + 1:], bundle_depth, limit=bundle_limit, held=held_versions(section, bundle_depth))
+        if received is None:
+            self.unbundled.add(host)
+        else:
+            entries.update(received)
+        for address in addresses:
+            if address.casefold() not in entries:
+                entries[address.casefold()] = self.fetch(host, address, generation)
+        return entries
+
+    def fetch(self, host, address, generation):
+        """Return the cache entry of the page, updated from the server, or None"""
+        if generation != self.generation:
             return None
-        next_offset += recv_size
-    return data
+        cached = page_cache.get(address)
+        version = cached["version"] if cached is not None and cached["version"] else None
+        with page_cache.temporary_file() as stream:
+            answer = query(host, address[len(host) + 1:], version=version, stream=stream, report=False,
+                           hashes=page_cache.hashes(cached) if version else None)
+        try:
+            if not answer or generation != self.generation:
+                return None
+            return cache_answer(address, answer, cached, stream.name)
+        finally:
+            if os.path.exists(stream.name):
+                os.unlink(stream.name)
 
-def query(host, path, port=default_port):
-    open_socket = socket.socket()
-    try:
-        open_socket.connect((host, port))
-        if path is not None and path != "":
-            path_bytes = bytes(path, "utf-8")
-            query_bytes = bytes([0x06, 0x0E, 0]) + len(path_bytes).to_bytes(2, byteorder="big") + path_bytes
+    def take(self, address):
+        """Return the cache entry of the page if it has been fetched for the current page, waiting if it is under way"""
+        with self.lock:
+            future = self.pending.get(address.casefold())
+            bundled = address.casefold() in self.bundled
+        if future is None or future.cancelled():
+            return None
+        try:
+            cached = future.result()
+        except Exception:
+            return None
+        if bundled:
+            cached = cached.get(address.casefold())
+        if cached is None or not os.path.exists(cached["file"]): # evicted meanwhile
+            return None
+        return cached
+
+    def close(self):
+        self.cancel()
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+class Fetch(threading.Thread):
+    """Gets a page off the window's thread and shows it, unless a later navigation has cancelled it meanwhile"""
+
+    def __init__(self, address, on_shown=None):
+        threading.Thread.__init__(self, daemon=True)
+        self.address = address
+        self.on_shown = on_shown # called after the page is shown
+        self.cancelled = False
+        self.socket = None
+        self.reported = 0
+        self.lock = threading.Lock()
+
+    def attach(self, open_socket):
+        """Register the socket the fetch waits on so that cancel can break it off; return False if cancelled already"""
+        with self.lock:
+            self.socket = open_socket
+            return not self.cancelled
+
+    def cancel(self):
+        with self.lock:
+            self.cancelled = True
+            if self.socket is not None:
+                try:
+                    self.socket.shutdown(socket.SHUT_RDWR) # wakes up a receive in progress
+                except OSError:
+                    pass
+
+    def progress(self, received, total=None):
+        if self.cancelled or time.monotonic() - self.reported < 0.2:
+            return
+        self.reported = time.monotonic()
+        if total:
+            status_bar.set_text("Receiving {}: {:,} of {:,} KB".format(self.address, received // 1024, total // 1024))
         else:
-            query_bytes = bytes([0x06, 0x0E, 0, 0, 0])
-        send(open_socket, query_bytes)
-    except Exception: # (ConnectionRefusedError) as e
-        status_bar.set_text("Remote server not responding")
-        return None
+            status_bar.set_text("Receiving {}: {:,} KB".format(self.address, received // 1024))
 
-    answer = receive(open_socket)
+    def run(self):
+        if fetch_page(self, self.address):
+            with display_lock:
+                if not self.cancelled and self.on_shown is not None:
+                    self.on_shown()
 
-    if answer[:2] != bytes([0x06, 0x0E]): # identifier
-        status_bar.set_text("Invalid server")
+def open_connection(host, port):
+    open_socket = socket.create_connection((host, port), connect_timeout)
+    open_socket.settimeout(read_timeout)
+    return open_socket
+
+def query(host, path, port=default_port, version=None, stream=None, report=True, fetch=None, hashes=None):
+    """Ask for a page; if the version of a copy at hand is given the server only sends the page if it has changed.
+    With the hashes of the files of that copy it sends only the files which differ.
+    If a file is given for stream, a server which can stream writes the page to it in chunks, never holding it in
+    memory; the page length in the answer is 0 then. Errors go to the status bar if report is set.
+    A fetch given is told the socket, so that it can be cancelled, and the bytes received.
+    For a page not at hand attachments are taken from the blob store where they are there already; they are put
+    into the page written to stream then, the answer has status "2"."""
+    if version is not None and hashes is not None:
+        message_type = MessageType.QueryDelta
+    elif stream is not None:
+        message_type = MessageType.QueryStream if version is not None else MessageType.QueryBlobs
+    else:
+        message_type = MessageType.Query if version is None else MessageType.QueryIfModified
+    payload = protocol.encode_query(path, version, hashes if message_type == MessageType.QueryDelta else None)
+    answer = request(host, port, message_type, payload, stream, report, fetch)
+    if answer and answer[0:1] == b"2" and not complete_page(host, port, answer, stream, fetch):
+        if fetch is not None and fetch.cancelled:
+            return None
+        answer = request(host, port, MessageType.QueryStream, payload, stream, report, fetch) # the whole page then
+    return answer
+
+def complete_page(host, port, answer, stream, fetch=None):
+    """Write the page of an answer with status "2" to stream with the attachments left out put back in, fetching
+    those not in the blob store; return False if that fails"""
+    page_answer = protocol.decode_page(answer)
+    missing = [blob for blob in page_answer.blobs if blob_store.get(blob.hash) is None]
+    while missing:
+        batch = []
+        while missing and (not batch or sum(blob.size for blob in batch) + missing[0].size <= blob_batch_size):
+            batch.append(missing.pop(0))
+        blobs_answer = request(host, port, MessageType.Blobs, protocol.encode_blobs(page_answer.path, [(blob.name, blob.hash) for blob in batch]),
+                               report=False, fetch=fetch)
+        if not blobs_answer:
+            return False
+        status, blobs = protocol.decode_blobs(blobs_answer)
+        if status != b"0" or len(blobs) != len(batch): # changed meanwhile
+            return False
+        for blob in blobs:
+            data = zlib.decompress(blob.data, -15) if blob.compression == 8 else bytes(blob.data)
+            if not blob_store.put(blob.hash, data):
+                return False
+
+    stream.seek(0)
+    stream.truncate()
+    with zipfile.ZipFile(io.BytesIO(page_answer.page)) as page, zipfile.ZipFile(stream, "w") as archive:
+        for info in page.infolist():
+            archive.writestr(info, page.read(info))
+        for blob in page_answer.blobs:
+            file_name = blob_store.get(blob.hash)
+            if file_name is None: # evicted meanwhile
+                return False
+            archive.write(file_name, blob.name)
+    stream.flush()
+    return True
+
+def bundle(host, path, depth, port=default_port, limit=0, held=None):
+    """Ask for a page with its subpages down to depth in one message and put them into the page cache; held gives
+    the versions of those in it as path relative to the page -> version. Return address casefolded -> cache entry
+    of the pages received, or None if the server does not send bundles."""
+    pages = []
+    answer = request(host, port, MessageType.Bundle, protocol.encode_bundle(path, depth, limit, held), report=False, pages=pages)
+    if not answer:
+        return {}
+    if not pages: # a page, from an older server answering as to a query, or the page is gone or the server busy
+        return None if answer[0:1] in (b"0", b"2") else {}
+    entries = {}
+    for page in pages[1:]:
+        page_path = protocol.decode_page(page).path
+        address = host + "/" + page_path if page_path else host
+        cached = page_cache.get(address)
+        if page[0:1] == b"3" and cached is None: # evicted meanwhile
+            continue
+        if page[0:1] == b"2": # attachments from the blob store, those not in it are fetched
+            with page_cache.temporary_file() as stream:
+                completed = complete_page(host, port, page, stream)
+            try:
+                entry = cache_answer(address, page, cached, stream.name) if completed else None
+            finally:
+                if os.path.exists(stream.name):
+                    os.unlink(stream.name)
+        else:
+            entry = cache_answer(address, page, cached, None)
+        if entry is not None:
+            entries[address.casefold()] = entry
+    return entries
+
+def held_versions(address, depth):
+    """Return relative path -> version of the page at address and the pages below it down to depth in the page cache"""
+    held = {}
+    pending = [("", 0)]
+    while pending and len(held) < 0xFFFF: # as many as the message takes
+        relative, level = pending.pop()
+        cached = page_cache.get(address + "/" + relative if relative else address)
+        if cached is None or not cached["version"]:
+            continue
+        held[relative] = cached["version"]
+        if level < depth:
+            pending += [(relative + "/" + name if relative else name, level + 1) for name in cached["subpages"]]
+    return held
+
+def request(host, port, message_type, payload, stream=None, report=True, fetch=None, pages=None):
+    """Send a message over a pooled connection and return the answer without identifier and message type as a
+    memoryview, or None. If the answer is a bundle the list given as pages is filled with its header and then its
+    pages, each like an answer to a query."""
+    answer = None
+    while answer is None:
+        open_socket, idle_timeout = connection_pool.acquire(host, port)
+        reused = open_socket is not None
+        try:
+            if not reused:
+                open_socket, idle_timeout = connection_pool.connect(host, port, fetch)
+            if fetch is not None and not fetch.attach(open_socket):
+                raise InterruptedError("Fetch cancelled")
+            protocol.send_message(open_socket, message_type, payload)
+            answer = protocol.receive_answer(open_socket, stream, fetch.progress if fetch is not None else None)
+            if answer is not None and answer[2:4] == MessageType.Bundle + b"0":
+                pages[:] = [memoryview(answer)[3:]]
+                while True:
+                    page = protocol.receive_message(open_socket)
+                    if page is None:
+                        raise ConnectionError("Bundle broken off")
+                    if not page: # end of bundle
+                        break
+                    pages.append(memoryview(page)[3:])
+        except ServerBusy:
+            if fetch is not None:
+                fetch.attach(None)
+            return memoryview(b"5") # like the answer on a connection which is not kept alive
+        except socket.timeout:
+            answer = None
+            reused = False # a slow server, not a stale connection
+        except Exception: # (ConnectionRefusedError) as e
+            answer = None
+        if fetch is not None:
+            fetch.attach(None)
+        if answer is None:
+            if open_socket is not None:
+                open_socket.close()
+            if fetch is not None and fetch.cancelled:
+                return None
+            if reused: # server has closed the idle connection meanwhile, try a fresh one
+                continue
+            if report:
+                status_bar.set_text("Remote server not responding")
+            return None
+
+    if answer[:2] != identifier:
+        open_socket.close()
+        if report:
+            status_bar.set_text("Invalid server")
         return None
-    open_socket.close()
-    return answer[3:]
+    if idle_timeout > 0:
+        connection_pool.release(host, port, open_socket, idle_timeout)
+    else:
+        open_socket.close()
+    return memoryview(answer)[3:]
 
-def get_page(address):
-    global page_open, page_open_name
+def search(host, words, port=default_port, limit=50):
+    """Return the paths, scores and snippets of the pages of the host best matching the words, or None"""
+    answer = request(host, port, MessageType.Search, protocol.encode_search(words, limit))
+    if not answer:
+        return None
+    status, results = protocol.decode_search(answer)
+    if status == b"5":
+        status_bar.set_text("Server busy, try again later")
+        return None
+    if status != b"0":
+        status_bar.set_text("The server does not search")
+        return None
+    return results
+
+def show_archive(file_name, name, version=None, blobs=None):
+    """Open the page in the archive in place of the one open and show Text.md straight from it; of the other files
+    only the pictures it refers to are extracted, or linked from the blob store if blobs gives their hashes"""
+    global page_open, page_extracted
+    close_page()
+    page_open = Page(file_name, name, version)
+    archive = page_open.archive
+    text = archive.read("Text.md").decode("utf-8")
+
+    if not version or page_extracted != file_name + version.hex(): # unless tmp_directory holds them already
+        clear_directory(tmp_directory)
+        for name in archive.namelist():
+            if name in ["Code.py", "Code.pyd"] or (name != "Text.md" and (name in text or urllib.parse.quote(name) in text)):
+                if blobs is None or name not in blobs or not blob_store.link(blobs[name], os.path.join(tmp_directory, name)):
+                    archive.extract(name, tmp_directory)
+        page_extracted = file_name + version.hex() if version else None
+    text_view.data = (text, tmp_directory)
+
+    attachments_listview.data = None
+    attachments_list.clear()
+    for name in archive.namelist():
+        if not name.endswith("/") and name not in ["Text.md", "Data.yml", "Code.py", "Code.pyd"]:
+            attachments_list.append([name])
+    attachments_listview.data = attachments_list
+
+def close_page():
+    """Close the archive of the page shown, so that the page cache can replace it"""
+    global page_open
+    if page_open is not None:
+        page_open.close()
+        page_open = None
+
+def display(action):
+    """Call action with display_lock held on a thread of its own, like a Fetch showing its page. A fetch holding the
+    lock sets widgets, which waits for the window's thread, so that thread must never wait for the lock itself.
+    The action is dropped if another fetch is started before it gets the lock, the later navigation wins."""
+    fetch = page_fetch
+    def run():
+        with display_lock:
+            if page_fetch is fetch:
+                action()
+    threading.Thread(target=run, daemon=True).start()
+
+def get_page(address, on_shown=None):
+    """Fetch and show a page in the background, cancelling the fetch under way; on_shown is called once it shows"""
+    global page_fetch
+    if page_fetch is not None:
+        page_fetch.cancel()
+    page_fetch = Fetch(address, on_shown)
+    status_bar.set_text("Connecting to " + address)
+    page_fetch.start()
+
+def fetch_page(fetch, address):
     separator = address.find("/")
     if  separator == -1:
         host = address
@@ -62,75 +657,95 @@ def get_page(address):
         host = address[:separator]
         path = address[separator + 1:]
 
-    answer = query(host, path)
+    cached = prefetcher.take(address)
+    if cached is not None: # fetched in the background while the previous page was shown
+        with display_lock:
+            if fetch.cancelled:
+                return False
+            show_entry(host, cached)
+        return True
+    prefetcher.cancel()
+
+    cached = page_cache.get(address)
+    version = None
+    if cached is not None and cached["version"]: # only servers which send versions understand a version in the query
+        version = cached["version"]
+    with page_cache.temporary_file() as stream:
+        answer = query(host, path, version=version, stream=stream, fetch=fetch, hashes=page_cache.hashes(cached) if version else None)
+    try:
+        with display_lock:
+            if fetch.cancelled:
+                return False
+            return show_answer(host, address, answer, cached, stream.name)
+    finally:
+        if os.path.exists(stream.name):
+            os.unlink(stream.name)
+
+def show_answer(host, address, answer, cached, stream_name):
     if not answer:
         return False
 
     if answer[0:1] == b"4":
-        path_lenght = int.from_bytes(answer[1: 3], byteorder='big')
-        path = answer[3 : 3 + path_lenght].decode("utf-8")
-        status_bar.set_text("Page not found: " + host + "/" + path)
+        status_bar.set_text("Page not found: " + host + "/" + protocol.decode_page(answer).path)
+        return False
+    if answer[0:1] == b"5":
+        status_bar.set_text("Server busy, try again later")
         return False
 
-    page_length = int.from_bytes(answer[1:5], byteorder='big')
-    page = answer[5:page_length + 5]
-
-    clear_directory(tmp_directory)
-    with zipfile.ZipFile(io.BytesIO(page), mode="r") as archive:
-        archive.extractall(tmp_directory)
+    close_page() # the cached file may be about to be replaced
+    show_entry(host, cache_answer(address, answer, cached, stream_name))
+    return True
 
-    pos = page_length + 5
-    path_lenght = int.from_bytes(answer[pos: pos + 2], byteorder='big')
-    path = answer[pos + 2 : pos + 2 + path_lenght].decode("utf-8")
+def cache_answer(address, answer, cached, stream_name):
+    """Put the page of an answer with status "0", "1", "2" or "3" into the page cache; return the cache entry or None"""
+    if answer[0:1] not in (b"0", b"1", b"2", b"3"):
+        return None
+    status, page, removed, path, subpages, version, blobs = protocol.decode_page(answer)
+    subpages = [name for name, time_stamp in subpages]
 
-    pos += path_lenght + 2
-    subdirectory_count = int.from_bytes(answer[pos: pos + 2], byteorder='big')
-    subdirectories = []
-    pos += 2
-    for index in range(subdirectory_count):
-        subdirectory_length = int.from_bytes(answer[pos: pos + 2], byteorder='big')
-        subdirectory = answer[pos + 2:pos + 2 + subdirectory_length]
-        pos += subdirectory_length + 6
-        subdirectories.append(subdirectory.decode("utf-8"))
+    if status == b"3": # not modified
+        cached["subpages"] = subpages
+    elif status == b"1": # only the files which differ from the cached page, streamed if they are large
+        cached = page_cache.patch(address, cached, io.BytesIO(page) if len(page) else stream_name, removed, path, subpages, version)
+    elif status == b"2": # completed from the blob store by query
+        cached = page_cache.put(address, stream_name, path, subpages, version, {blob.name: blob.hash for blob in blobs})
+    elif len(page) == 0: # streamed
+        cached = page_cache.put(address, stream_name, path, subpages, version)
+    else:
+        cached = page_cache.put(address, page, path, subpages, version)
+    return cached
 
-    text = pathlib.Path(os.path.join(tmp_directory, "Text.md")).read_text(encoding="utf-8")
-    text_view.data = (text, tmp_directory)
+def show_entry(host, cached):
+    """Show a page from the page cache and start fetching the pages around it"""
+    path = cached["path"]
     if path == "":
+        show_archive(cached["file"], host, cached["version"], cached.get("blobs"))
         entry_path.data = host
         set_window_caption(host)
         button_up.enabled = False
         menu_item_navigate_up.enabled = False
     else:
+        show_archive(cached["file"], path[path.rfind("/") + 1:], cached["version"], cached.get("blobs"))
         entry_path.data = host + "/" + path
-        separator = path.find("/")
-        if  separator == -1:
-            page_open_name = path
-        else:
-            page_open_name = path[separator + 1:]
-        set_window_caption(page_open_name)
+        set_window_caption(page_open.name)
         button_up.enabled = True
         menu_item_navigate_up.enabled = True
 
     listview_subpage.data = None
     subpage_list.clear()
-    for subdirectory in subdirectories:
+    for subdirectory in cached["subpages"]:
         subpage_list.append([subdirectory])
     listview_subpage.data = subpage_list
 
-    attachments_listview.data = None
-    attachments_list.clear()
-    with os.scandir(tmp_directory) as iterator:
-        for entry in iterator:
-            if entry.is_file() and entry.name not in ["Text.md", "Data.yml", "Code.py", "Code.pyd"]:
-                attachments_list.append([entry.name])
-    attachments_listview.data = attachments_list
-
-    page_open = page
     status_bar.set_text(None)
 
-    execute_code()
+    address = entry_path.data
+    nearby = [address + "/" + subdirectory for subdirectory in cached["subpages"][:prefetch_limit]]
+    if path != "":
+        nearby.append(address[:address.rfind("/")]) # for "Up"
+    prefetcher.prefetch(host, nearby, address)
 
-    return True
+    execute_code()
 
 def save_state():
     position = ty.app.window.position
@@ -151,6 +766,15 @@ def load_state():
 
 def window__before_close(self):
     save_state()
+    if page_fetch is not None:
+        page_fetch.cancel()
+    prefetcher.close()
+    connection_pool.close()
+    if display_lock.acquire(blocking=False): # else a fetch is showing its page, its archive is closed on exit
+        try:
+            close_page()
+        finally:
+            display_lock.release()
     return True
 
 def clear_directory(path):
@@ -161,29 +785,18 @@ def clear_directory(path):
             shutil.rmtree(os.path.join(root, d))
 
 def open_page(file_name):
-    clear_directory(tmp_directory)
-
-    with zipfile.ZipFile(file_name, mode="r") as archive:
-        archive.extractall(tmp_directory)
+    if page_fetch is not None:
+        page_fetch.cancel() # would show its page over this one
+    display(lambda: show_file(file_name)) # after a fetch showing its page at the moment is done
 
-    text = pathlib.Path(os.path.join(tmp_directory, "Text.md")).read_text(encoding="utf-8")
-    text_view.data = (text, tmp_directory)
+def show_file(file_name):
+    show_archive(file_name, os.path.splitext(os.path.basename(file_name))[0])
     set_window_caption(file_name)
 
     listview_subpage.data = None
     subpage_list.clear()
 
-    attachments_listview.data = None
-    attachments_list.clear()
-    with os.scandir(tmp_directory) as iterator:
-        for entry in iterator:
-            if entry.is_file() and entry.name not in ["Text.md", "Data.yml", "Code.py", "Code.pyd"]:
-                attachments_list.append([entry.name])
-    attachments_listview.data = attachments_list
-
     entry_path.data = None
-    global page_open
-    page_open = file_name
     button_up.enabled = False
     menu_item_navigate_up.enabled = False
     execute_code()
@@ -207,6 +820,14 @@ def set_navigation_stack(address):
         button_forward.enabled = False
         menu_item_navigate_forward.enabled = False
 
+def set_navigation_stack_index(index):
+    global navigation_stack_index
+    navigation_stack_index = index
+    button_back.enabled = True if navigation_stack_index > 0 else False
+    menu_item_navigate_back.enabled = True if navigation_stack_index > 0 else False
+    button_forward.enabled = True if len(navigation_stack) > navigation_stack_index + 1 else False
+    menu_item_navigate_forward.enabled = True if len(navigation_stack) > navigation_stack_index + 1 else False
+
 def menu_item_file_open__on_click():
     selector = ty.FileSelector("Open file", extension="mdp")
     file_name = selector.run()
@@ -214,19 +835,24 @@ def menu_item_file_open__on_click():
         open_page(file_name)
 
 def menu_item_file_save__on_click():
-    if page_open == None:
+    page = page_open # the one shown when asked, a fetch may show another meanwhile
+    if page == None:
         return
-    selector = ty.FileSelector("Save As", base_directory, page_open_name, extension="mdp", save = True)
+    selector = ty.FileSelector("Save As", base_directory, page.name, extension="mdp", save = True)
     file_name = selector.run()
     if file_name:
-        with open(file_name, "wb") as file:
-            file.write(page_open)
+        page.save_as(file_name)
         status_bar.set_text("Page saved as '" + file_name + "'")
 
 def menu_item_file_close__on_click():
+    if page_fetch is not None:
+        page_fetch.cancel() # would show its page after all
+    display(clear_page)
+
+def clear_page():
     text_view.data = (" ", tmp_directory)
     set_window_caption(None)
-    page_open = None
+    close_page()
     listview_subpage.data = None
     attachments_listview.data = None
 
@@ -245,28 +871,59 @@ def menu_item_navigate_up__on_click():
         host = address[:separator]
         path = address[separator + 1:]
 
-    if get_page(address):
-        set_navigation_stack(address)
+    get_page(address, lambda: set_navigation_stack(address))
 
 def menu_item_navigate_back__on_click():
-    global navigation_stack_index
     if navigation_stack_index > 0:
-        navigation_stack_index -= 1
-        if get_page(navigation_stack[navigation_stack_index]):
-            button_back.enabled = True if navigation_stack_index > 0 else False
-            menu_item_navigate_back.enabled = True if navigation_stack_index > 0 else False
-            button_forward.enabled = True
-            menu_item_navigate_forward.enabled = True
+        get_page(navigation_stack[navigation_stack_index - 1], lambda: set_navigation_stack_index(navigation_stack_index - 1))
 
 def menu_item_navigate_forward__on_click():
-    global navigation_stack_index
     if len(navigation_stack) > navigation_stack_index + 1:
-        navigation_stack_index += 1
-        if get_page(navigation_stack[navigation_stack_index]):
-            button_back.enabled = True
-            menu_item_navigate_back.enabled = True
-            button_forward.enabled = True if len(navigation_stack) > navigation_stack_index + 1 else False
-            menu_item_navigate_forward.enabled = True if len(navigation_stack) > navigation_stack_index + 1 else False
+        get_page(navigation_stack[navigation_stack_index + 1], lambda: set_navigation_stack_index(navigation_stack_index + 1))
+
+def menu_item_navigate_search__on_click():
+    address = entry_path.data or default_host
+    host = address.split("/")[0]
+    results = []
+
+    def find(self=None):
+        words = entry_words.input_string
+        if not words:
+            return
+        status_bar.set_text("Searching " + host + " for '" + words + "'")
+        threading.Thread(target=show_results, args=(words,), daemon=True).start() # like Fetch, not on the window's thread
+
+    def show_results(words):
+        found = search(host, words)
+        if found is None:
+            return
+        with display_lock:
+            listview_results.data = None
+            results.clear()
+            for path, score, snippet in found:
+                results.append([path or "/", snippet])
+            listview_results.data = results
+            status_bar.set_text("{} page(s) found".format(len(results)))
+
+    def on_key(key, widget):
+        if key == ty.Key.enter:
+            find()
+
+    def on_double_click(self, row):
+        page_address = host if results[row][0] == "/" else host + "/" + results[row][0]
+        get_page(page_address, lambda: set_navigation_stack(page_address))
+
+    window = ty.Window("Search " + host, width = 560, height = 400)
+    window.icon = icon
+    entry_words = ty.Entry(window, "words", 5, 5, -50, 22)
+    entry_words.on_key = on_key
+    button_find = ty.Button(window, "find", -40, 5, -5, 22, "Find")
+    button_find.on_click = find
+    listview_results = ty.ListView(window, "results", 5, 32, -5, -5)
+    listview_results.columns = [["Page", str, 170], ["Text", str, 360]]
+    listview_results.on_double_click = on_double_click
+
+    window.run()
 
 def menu_item_about__on_click():
     window = ty.Window("About Markdown Page", width = 320, height = 240)
@@ -279,8 +936,7 @@ def menu_item_about__on_click():
 
 def button_get__on_click(self):
     address = entry_path.input_string
-    if get_page(address):
-        set_navigation_stack(address)
+    get_page(address, lambda: set_navigation_stack(address))
 
 def entry_path__on_key(key, widget):
     if key == ty.Key.enter:
@@ -301,15 +957,21 @@ def listview_subpage__on_row_canged(self):
     else:
         address = entry_path.data + "/" + subpage_list[self.row][0]
 
-    if get_page(address):
-        set_navigation_stack(address)
+    get_page(address, lambda: set_navigation_stack(address))
 
 def attachments_listview__on_double_click(self, row):
-    selector = ty.FileSelector("Save As", name=attachments_list[row][0], extension="mdp", save = True)
+    name = attachments_list[row][0]
+    selector = ty.FileSelector("Save As", name=name, extension="mdp", save = True)
     file_name = selector.run()
     if file_name:
-        shutil.copy2(os.path.join(tmp_directory, attachments_list[row][0]), file_name)
-        status_bar.set_text("Attachment saved as '" + file_name + "'")
+        display(lambda: save_attachment(name, file_name))
+
+def save_attachment(name, file_name):
+    if page_open is None or name not in page_open.archive.namelist(): # a fetch has shown another page meanwhile
+        return
+    with page_open.archive.open(name) as source, open(file_name, "wb") as target: # inflated only now
+        shutil.copyfileobj(source, target)
+    status_bar.set_text("Attachment saved as '" + file_name + "'")
 
 def text_view__on_click_link(self, link):
     if link[:4] == "http" or link[:5] == "https":
@@ -353,6 +1015,7 @@ menu_navigate = ty.Menu(menu, "navigate", "&Navigate")
 menu_item_navigate_up = ty.MenuItem(menu_navigate, "up", "&Up", menu_item_navigate_up__on_click)
 menu_item_navigate_back = ty.MenuItem(menu_navigate, "back", "&Back", menu_item_navigate_back__on_click)
 menu_item_navigate_forward = ty.MenuItem(menu_navigate, "forward", "&Forward", menu_item_navigate_forward__on_click)
+menu_item_navigate_search = ty.MenuItem(menu_navigate, "search", "&Search...\tCtrl+F", menu_item_navigate_search__on_click)
 menu_help = ty.Menu(menu, "help", "&Help")
 menu_item_about = ty.MenuItem(menu_help, "about", "&About...", menu_item_about__on_click, ty.Icon(ty.StockIcon.information))
 """"
@@ -405,8 +1068,14 @@ subpage_list = []
 attachments_list = []
 navigation_stack = []
 navigation_stack_index = -1
-page_open = None
-page_open_name = None
+page_open = None # Page shown
+page_extracted = None # archive file and version of the page whose pictures are in tmp_directory
+page_fetch = None # the latest Fetch started
+display_lock = threading.Lock() # held by the thread showing a page or clearing it, never taken on the window's thread
+connection_pool = ConnectionPool()
+page_cache = PageCache(os.path.join(base_directory, "cache"))
+blob_store = BlobStore(os.path.join(base_directory, "cache", "Blobs"))
+prefetcher = Prefetcher()
 
 if len(sys.argv) > 1:
     address = sys.argv[1]
@@ -0,0 +1,290 @@
+# Mirror of a Markdown Page site
+# Thomas Führinger, 2022, https://github.com/thomasfuhringer/MarkdownPage
+
+"""
+Fetches the pages of a site from its server into a directory tree of .mdp files, the home page as
+<host>.mdp and every other page as <host>/<path>.mdp, several pages at a time.
+The tree is taken from one list message; pages whose content hash is the same as in the last run are not
+fetched again, so an interrupted mirror is resumed where it stopped. From servers which cannot list pages
+the tree is walked from the home page along the subpages, asking for each page only if it has been modified.
+
+python mirror.py 45.76.133.182 Mirror --parallel 8
+"""
+
+import argparse, concurrent.futures, json, os, socket, threading, time
+import protocol
+from protocol import identifier, MessageType, ServerBusy
+
+default_port = 1550
+default_parallel = 8 # pages fetched at a time
+default_depth = 255 # levels of subpages below the start page, at most 255 in a list message
+connect_timeout = 5 # seconds
+read_timeout = 60 # seconds to wait for the next bytes of an answer
+state_name = "Mirror.json"
+save_interval = 50 # pages fetched between saves of the state
+busy_retries = 6 # times a connection is tried again when the server is busy, waiting twice as long each time
+busy_wait = 0.5 # seconds before the first retry
+
+def join(path, name):
+    return path + "/" + name if path and name else path or name
+
+def valid_path(path):
+    """Whether a page path from the server gives a file name inside the mirror directory: none of its elements may
+    be empty, . or .., contain a separator of the OS or a drive"""
+    if path == "":
+        return True
+    for element in path.split("/"):
+        if element in ("", ".", "..") or os.sep in element or (os.altsep and os.altsep in element) or os.path.splitdrive(element)[0]:
+            return False
+    return True
+
+class Connections(object):
+    """A kept alive connection to the server for every thread"""
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.persistent = True # until the server refuses to keep a connection
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.open = []
+
+    def connect(self):
+        connection = socket.create_connection((self.host, self.port), connect_timeout)
+        connection.settimeout(read_timeout)
+        if self.persistent:
+            try:
+                idle_timeout = protocol.keep_alive(connection)
+            except ServerBusy:
+                connection.close()
+                raise
+            if idle_timeout is not None:
+                self.local.connection = connection
+                with self.lock:
+                    self.open.append(connection)
+                return connection
+            connection.close()
+            self.persistent = False
+            return self.connect()
+        return connection
+
+    def request(self, message_type, payload, stream=None):
+        """Send a message and return the answer without identifier and message type; a streamed page is written to
+        stream. Raises OSError if the server does not answer, or is still busy after some retries."""
+        retries = 0
+        while True:
+            connection = getattr(self.local, "connection", None)
+            reused = connection is not None
+            try:
+                if connection is None:
+                    connection = self.connect()
+                protocol.send_message(connection, message_type, payload)
+                answer = protocol.receive_answer(connection, stream)
+                if answer is None:
+                    raise ConnectionError("Connection closed")
+                if answer[:2] != identifier:
+                    raise ConnectionError("Invalid server")
+                if protocol.busy(answer):
+                    raise ServerBusy("Server busy")
+            except ServerBusy:
+                self.close(connection)
+                if retries == busy_retries:
+                    raise
+                time.sleep(busy_wait * 2 ** retries)
+                retries += 1
+                continue
+            except OSError:
+                self.close(connection)
+                if reused: # closed by the server while idle, try a fresh one
+                    if stream is not None:
+                        stream.seek(0)
+                        stream.truncate()
+                    continue
+                raise
+            if getattr(self.local, "connection", None) is not connection:
+                connection.close()
+            return memoryview(answer)[3:]
+
+    def close(self, connection):
+        if connection is None:
+            return
+        connection.close()
+        if getattr(self.local, "connection", None) is connection:
+            self.local.connection = None
+            with self.lock:
+                self.open.remove(connection)
+
+    def close_all(self):
+        with self.lock:
+            for connection in self.open:
+                connection.close()
+            self.open = []
+
+class Mirror(object):
+    """Pages of a host in a directory, with what was fetched last recorded in Mirror.json"""
+
+    def __init__(self, host, port, directory, parallel=default_parallel):
+        self.host = host
+        self.directory = directory
+        self.parallel = parallel
+        self.connections = Connections(host, port)
+        self.state_path = os.path.join(directory, state_name)
+        self.lock = threading.Lock()
+        self.fetched = self.kept = self.removed = self.failed = 0
+        try:
+            with open(self.state_path, encoding="utf-8") as file:
+                self.state = json.load(file) # path -> dict(version, time_stamp, size, content_hash), hashes as hex
+        except (OSError, ValueError):
+            self.state = {}
+
+    def save(self):
+        with self.lock:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(self.state_path + ".tmp", "w", encoding="utf-8") as file:
+                json.dump(self.state, file)
+            os.replace(self.state_path + ".tmp", self.state_path)
+
+    def file_name(self, path):
+        if not valid_path(path):
+            raise ValueError("Invalid page path '{}'".format(path))
+        if path == "":
+            return os.path.join(self.directory, self.host + ".mdp")
+        return os.path.join(self.directory, self.host, *path.split("/")) + ".mdp"
+
+    def unchanged(self, path, entry):
+        known = self.state.get(path)
+        return known is not None and known.get("content_hash") == entry.content_hash.hex() and os.path.exists(self.file_name(path))
+
+    def list(self, path, depth):
+        """Return the pages below path down to depth as path -> protocol.ListEntry, or None if the server cannot list"""
+        try:
+            answer = self.connections.request(MessageType.List, protocol.encode_list(path, min(depth, 255)))
+            status, listed_path, entries = protocol.decode_list(answer)
+        except socket.timeout: # an older server choking on the message
+            return None
+        except ValueError: # an older server answering with a page
+            return None
+        if status != b"0":
+            return None
+        listing = {}
+        for entry in entries:
+            page = join(listed_path, entry.path)
+            if valid_path(page):
+                listing[page] = entry
+            else:
+                print("Invalid page path: '{}'".format(page))
+                self.failed += 1
+        return listing
+
+    def fetch(self, path, entry=None):
+        """Write the page to its file unless the copy there is current; return the paths of its subpages"""
+        file_name = self.file_name(path)
+        known = self.state.get(path, {})
+        version = bytes.fromhex(known["version"]) if known.get("version") and os.path.exists(file_name) else None
+        os.makedirs(os.path.dirname(file_name), exist_ok=True)
+        try:
+            with open(file_name + ".tmp", "wb") as stream:
+                answer = self.connections.request(MessageType.QueryStream, protocol.encode_query(path, version), stream)
+                status, page, removed, answer_path, subpages, answer_version, blobs = protocol.decode_page(answer)
+                if status == b"0" and len(page) > 0: # not streamed
+                    stream.write(page)
+            if status == b"0":
+                os.replace(file_name + ".tmp", file_name)
+            else:
+                os.unlink(file_name + ".tmp")
+        except OSError as exception:
+            print("Failed to fetch '{}': {}".format(path, exception))
+            with self.lock:
+                self.failed += 1
+            return []
+        if status == b"4":
+            print("Page not found: '{}'".format(path))
+            with self.lock:
+                self.failed += 1
+            return []
+
+        record = {"version": answer_version.hex() if status == b"0" else known.get("version")}
+        if entry is not None:
+            record.update(time_stamp=entry.time_stamp, size=entry.size, content_hash=entry.content_hash.hex())
+        with self.lock:
+            self.state[path] = record
+            if status == b"0":
+                self.fetched += 1
+                fetched = self.fetched
+                print("Fetched '{}'".format(path))
+            else:
+                self.kept += 1
+                fetched = 0
+        if fetched % save_interval == 0 and fetched > 0:
+            self.save()
+        subpage_paths = []
+        for name, time_stamp in subpages:
+            subpage = join(answer_path, name)
+            if valid_path(subpage):
+                subpage_paths.append(subpage)
+            else:
+                print("Invalid page path: '{}'".format(subpage))
+                with self.lock:
+                    self.failed += 1
+        return subpage_paths
+
+    def remove(self, path, depth, listing):
+        """Delete the files of pages below path down to depth which the server no longer has"""
+        for known in list(self.state):
+            relative = known[len(path):].lstrip("/") if path else known
+            if known in listing or not (known == path or known.startswith(path + "/") or path == ""):
+                continue
+            if (relative.count("/") + 1 if relative else 0) > depth:
+                continue
+            try:
+                os.unlink(self.file_name(known))
+            except (OSError, ValueError): # a path recorded by an earlier version without the check
+                pass
+            del self.state[known]
+            self.removed += 1
+
+    def run(self, path="", depth=default_depth):
+        try:
+            listing = self.list(path, depth)
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.parallel) as executor:
+                if listing is not None:
+                    futures = [executor.submit(self.fetch, page, entry) for page, entry in listing.items() if not self.unchanged(page, entry)]
+                    self.kept += len(listing) - len(futures)
+                    concurrent.futures.wait(futures)
+                    self.remove(path, min(depth, 255), listing)
+                else:
+                    pending = {executor.submit(self.fetch, path): 0}
+                    while pending:
+                        done, not_done = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                        for future in done:
+                            level = pending.pop(future)
+                            if level < depth:
+                                for subpage in future.result():
+                                    pending[executor.submit(self.fetch, subpage)] = level + 1
+        finally:
+            self.connections.close_all()
+            self.save()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Mirror the pages of a Markdown Page site into a directory")
+    parser.add_argument("host")
+    parser.add_argument("directory", help="where the .mdp files are written")
+    parser.add_argument("--port", type=int, default=default_port)
+    parser.add_argument("--path", default="", help="page to start from, the home page by default")
+    parser.add_argument("--depth", type=int, default=default_depth, help="levels of subpages below the start page")
+    parser.add_argument("--parallel", type=int, default=default_parallel, help="pages fetched at a time")
+    arguments = parser.parse_args()
+
+    path = arguments.path.strip("/")
+    if not valid_path(path):
+        print("Invalid page path: '{}'".format(arguments.path))
+        raise SystemExit(1)
+    mirror = Mirror(arguments.host, arguments.port, arguments.directory, arguments.parallel)
+    try:
+        mirror.run(path, arguments.depth)
+    except OSError as exception:
+        print("Remote server not responding: {}".format(exception))
+        raise SystemExit(1)
+    print("{} page(s) fetched, {} unchanged, {} removed, {} failed.".format(mirror.fetched, mirror.kept, mirror.removed, mirror.failed))
+    if mirror.failed:
+        raise SystemExit(1)
@@ -0,0 +1,358 @@
+# Wire protocol of Markdown Page
+# Thomas Führinger, 2022, https://github.com/thomasfuhringer/MarkdownPage
+
+"""
+Encoding and decoding of the messages exchanged by server.py and its clients; the protocol itself is described
+in server.py. Nothing here depends on the GUI, so other tools can talk to a server with it.
+
+Answers are decoded through memoryviews, so a page is never copied out of the message it arrived in, and messages
+are written header and payload together with one scatter-gather call where the platform has sendmsg.
+"""
+
+import struct, collections, socket, time, os
+
+identifier = bytes([0x06, 0x0E])
+
+class MessageType:
+    Query = b"\x00"
+    KeepAlive = b"\x01"
+    QueryIfModified = b"\x02"
+    QueryStream = b"\x03"
+    List = b"\x04"
+    QueryDelta = b"\x05"
+    Search = b"\x06"
+    QueryBlobs = b"\x07"
+    Blobs = b"\x08"
+    Bundle = b"\x09"
+    Stats = b"\xFE"
+    ShutDown = b"\xFF"
+    Response = b"\xFF" # type of the answers of the server
+
+header = struct.Struct(">I2sc") # message length, identifier, message type
+length_field = struct.Struct(">I")
+u16 = struct.Struct(">H")
+u32 = struct.Struct(">I")
+u64 = struct.Struct(">Q")
+version_length = 32
+hash_length = 32
+try: # buffers one sendmsg call takes at most, it fails with EMSGSIZE on more
+    max_buffers = os.sysconf("SC_IOV_MAX")
+except (AttributeError, ValueError, OSError): # Windows or not known
+    max_buffers = -1
+if max_buffers <= 0:
+    max_buffers = 1024
+
+PageAnswer = collections.namedtuple("PageAnswer", "status page removed path subpages version blobs")
+PageAnswer.__doc__ = """Answer to a query; page is a memoryview into the message, empty if it was streamed, removed
+the files left out of a delta, subpages a list of (name, time stamp in Julian minutes) and blobs the BlobReference
+of each file left out of a page (status "2")"""
+BlobReference = collections.namedtuple("BlobReference", "name hash size")
+Blob = collections.namedtuple("Blob", "hash compression size data") # compression 0 stored, 8 deflated as in zip
+ListEntry = collections.namedtuple("ListEntry", "path time_stamp size content_hash")
+SearchResult = collections.namedtuple("SearchResult", "path score snippet")
+
+# framing
+
+def frame_parts(message_type, *parts):
+    """Return the buffers of a message, its header first, to be written in one go"""
+    length = len(identifier) + 1 + sum(len(part) for part in parts)
+    return [header.pack(length, identifier, message_type)] + [part for part in parts if len(part)]
+
+def frame(*parts, message_type=MessageType.Response):
+    """Return a message as one bytes object, for responses which are kept in a cache"""
+    return b"".join(frame_parts(message_type, *parts))
+
+def send_buffers(connection, buffers, deadline=None):
+    """Send the buffers in scatter-gather calls. If a deadline on time.monotonic is given socket.timeout is raised
+    when it passes, however the bytes trickle out."""
+    if not hasattr(connection, "sendmsg"): # Windows
+        if deadline is not None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise socket.timeout("Deadline passed")
+            connection.settimeout(remaining) # the total for sendall
+        connection.sendall(b"".join(buffers))
+        return
+    buffers = [memoryview(buffer).cast("B") for buffer in buffers if len(buffer)]
+    first = 0
+    while first < len(buffers):
+        if deadline is not None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise socket.timeout("Deadline passed")
+            connection.settimeout(remaining)
+        sent = connection.sendmsg(buffers[first:first + max_buffers])
+        while sent > 0: # skip what has gone, maybe part of a buffer
+            if sent >= len(buffers[first]):
+                sent -= len(buffers[first])
+                first += 1
+            else:
+                buffers[first] = buffers[first][sent:]
+                sent = 0
+
+def send_message(connection, message_type, *parts):
+    send_buffers(connection, frame_parts(message_type, *parts))
+
+def receive_into(connection, view, progress=None, offset=0, deadline=None):
+    """Fill the view from the connection; return False if it is closed before. If a deadline on time.monotonic
+    is given socket.timeout is raised when it passes, however the bytes trickle in."""
+    received = 0
+    while received < len(view):
+        if deadline is not None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise socket.timeout("Deadline passed")
+            connection.settimeout(remaining)
+        size = connection.recv_into(view[received:], len(view) - received)
+        if size == 0:
+            return False
+        received += size
+        if progress is not None:
+            progress(offset + received, offset + len(view))
+    return True
+
+def receive_message(connection, progress=None, deadline=None, limit=None):
+    """Return the next message without its length, starting with identifier and message type, or None if the
+    connection is closed; progress is called with the bytes received so far and the length.
+    Raises ValueError if the message is longer than limit, before anything is allocated for it."""
+    length_bytes = bytearray(4)
+    if not receive_into(connection, memoryview(length_bytes), deadline=deadline):
+        return None
+    length = length_field.unpack(length_bytes)[0]
+    if limit is not None and length > limit:
+        raise ValueError("Message of {} bytes too long".format(length))
+    data = bytearray(length)
+    if not receive_into(connection, memoryview(data), progress, deadline=deadline):
+        return None
+    return data
+
+def chunk_header(length):
+    """Length preceding a chunk of a streamed page"""
+    return length_field.pack(length)
+
+end_of_stream = chunk_header(0) # after the last chunk of a streamed page, or the last page of a bundle
+
+def receive_stream(connection, file, progress=None, chunk_size=64 * 1024):
+    """Write the chunks of a streamed page to file up to the empty one; return False if the connection breaks"""
+    length_bytes = bytearray(4)
+    buffer = memoryview(bytearray(chunk_size))
+    received = 0
+    while True:
+        if not receive_into(connection, memoryview(length_bytes)):
+            return False
+        length = length_field.unpack(length_bytes)[0]
+        if length == 0:
+            return True
+        while length > 0:
+            size = connection.recv_into(buffer, min(length, len(buffer)))
+            if size == 0:
+                return False
+            file.write(buffer[:size])
+            length -= size
+            received += size
+            if progress is not None:
+                progress(received)
+
+# client side of a connection
+
+class ServerBusy(ConnectionError):
+    """The server takes no more connections at the moment"""
+
+def busy(message):
+    """Whether a message, with identifier and message type, is the answer of a server too busy to serve the connection"""
+    return message[2:4] == MessageType.Response + b"5"
+
+def keep_alive(connection):
+    """Ask the server to keep the connection open; return the idle timeout granted, or None if the server does not
+    keep connections or has closed this one. Raises ServerBusy if it takes no more connections."""
+    send_message(connection, MessageType.KeepAlive)
+    message = receive_message(connection)
+    if message is not None and message[:3] == identifier + MessageType.KeepAlive:
+        return decode_keep_alive(memoryview(message)[3:])
+    if message is not None and busy(message):
+        raise ServerBusy("Server busy")
+    return None
+
+def receive_answer(connection, stream=None, progress=None):
+    """Return the next message like receive_message. The page of a streamed answer, or the delta of a large one, is
+    written to stream; the message is returned with the same layout as an answer with the page inside, its length 0.
+    Raises ConnectionError if the stream is broken off."""
+    message = receive_message(connection, progress)
+    if message is not None and message[2:4] in (MessageType.QueryStream + b"0", MessageType.QueryStream + b"1"):
+        stream.seek(0)
+        stream.truncate()
+        if not receive_stream(connection, stream, progress):
+            raise ConnectionError("Stream broken off")
+        message = message[:4] + bytes(4) + message[4:]
+    return message
+
+# fields
+
+def field(data):
+    """Return bytes preceded by their length in 2 bytes"""
+    return u16.pack(len(data)) + data
+
+def path_field(path_elements):
+    return field(bytes("/".join(path_elements), "utf-8"))
+
+def names_field(names):
+    return u16.pack(len(names)) + b"".join(field(bytes(name, "utf-8")) for name in names)
+
+def hashes_field(hashes):
+    return u16.pack(len(hashes)) + b"".join(field(bytes(name, "utf-8")) + digest for name, digest in hashes.items())
+
+def subpages_field(subpages):
+    """Subpage list of a response to a query from (name, time stamp in Julian minutes)"""
+    return u16.pack(len(subpages)) + b"".join(field(bytes(name, "utf-8")) + u32.pack(time_stamp) for name, time_stamp in subpages)
+
+def list_entries_field(entries):
+    """Pages of the answer to a list message from their ListEntry"""
+    return u32.pack(len(entries)) + b"".join(field(bytes(entry.path, "utf-8")) + u32.pack(entry.time_stamp) + u64.pack(entry.size) +
+                                              entry.content_hash for entry in entries)
+
+class Reader(object):
+    """Reads the fields of a message one after the other without copying; reading bytes past the end gives empty
+    views, as answers of older servers end early, reading a number past the end raises ValueError"""
+
+    def __init__(self, data, position=0):
+        self.view = memoryview(data).cast("B")
+        self.position = position
+
+    def unpack(self, format):
+        if self.position + format.size > len(self.view):
+            raise ValueError("Message ends early")
+        value = format.unpack_from(self.view, self.position)[0]
+        self.position += format.size
+        return value
+
+    def u8(self):
+        if self.position >= len(self.view):
+            raise ValueError("Message ends early")
+        self.position += 1
+        return self.view[self.position - 1]
+
+    def u16(self):
+        return self.unpack(u16)
+
+    def u32(self):
+        return self.unpack(u32)
+
+    def u64(self):
+        return self.unpack(u64)
+
+    def bytes(self, length):
+        self.position += length
+        return self.view[self.position - length:self.position]
+
+    def field(self):
+        return self.bytes(self.u16())
+
+    def string(self):
+        return str(self.field(), "utf-8")
+
+    def rest(self):
+        return self.bytes(len(self.view) - self.position)
+
+    def at_end(self):
+        return self.position >= len(self.view)
+
+# requests
+
+def encode_query(path, version=None, hashes=None):
+    """Payload of a query, query if modified or streamed query with version, or of a delta query with hashes too"""
+    payload = field(bytes(path or "", "utf-8"))
+    if version is not None:
+        payload += version
+        if hashes is not None:
+            payload += hashes_field(hashes)
+    return payload
+
+def encode_list(path, depth):
+    return field(bytes(path or "", "utf-8")) + bytes([depth])
+
+def encode_search(words, limit):
+    return field(bytes(words, "utf-8")) + bytes([limit])
+
+def encode_blobs(path, blobs):
+    """Payload of a blobs message for the files of the page at path given as (name, hash)"""
+    return field(bytes(path or "", "utf-8")) + hashes_field(dict(blobs))
+
+def encode_bundle(path, depth, limit=0, held=None):
+    """Payload of a bundle message; held gives the versions of pages the client has as path relative to the
+    page at path -> version, limit 0 leaves the bytes sent up to the server"""
+    return field(bytes(path or "", "utf-8")) + bytes([depth]) + u64.pack(limit) + hashes_field(held or {})
+
+def decode_request(message):
+    """Return the message type, the path (or words) and a Reader positioned after it of a message from a client"""
+    reader = Reader(message, len(identifier))
+    message_type = bytes(reader.bytes(1))
+    path = bytes(reader.field()) if not reader.at_end() else b""
+    return message_type, path, reader
+
+def decode_hashes(reader):
+    """Return the file names and hashes of a delta query as a dictionary"""
+    hashes = {}
+    if reader.at_end():
+        return hashes
+    for index in range(reader.u16()):
+        name = reader.string()
+        hashes[name] = bytes(reader.bytes(hash_length))
+    return hashes
+
+# answers, given without identifier and message type
+
+def decode_page(answer):
+    reader = Reader(answer)
+    status = bytes(reader.bytes(1))
+    if status == b"4":
+        return PageAnswer(status, None, [], reader.string(), [], b"", [])
+    page = reader.bytes(reader.u32()) if status in (b"0", b"1", b"2") else None
+    removed = [reader.string() for index in range(reader.u16())] if status == b"1" else []
+    blobs = []
+    if status == b"2":
+        for index in range(reader.u16()):
+            blobs.append(BlobReference(reader.string(), bytes(reader.bytes(hash_length)), reader.u64()))
+    path = reader.string()
+    subpages = []
+    for index in range(reader.u16()):
+        name = reader.string()
+        subpages.append((name, reader.u32()))
+    return PageAnswer(status, page, removed, path, subpages, bytes(reader.bytes(version_length)), blobs)
+
+def blob_record(digest, compression, size, data):
+    return digest + bytes([compression]) + u64.pack(size) + u32.pack(len(data)) + data
+
+def decode_blobs(answer):
+    """Return the status and the Blob of each file sent in an answer to a blobs message; data is a memoryview"""
+    reader = Reader(answer)
+    status = bytes(reader.bytes(1))
+    blobs = []
+    if status == b"0":
+        for index in range(reader.u16()):
+            blobs.append(Blob(bytes(reader.bytes(hash_length)), reader.u8(), reader.u64(), reader.bytes(reader.u32())))
+    return status, blobs
+
+def decode_list(answer):
+    """Return the status, the path and the ListEntry of each page of an answer to a list message"""
+    reader = Reader(answer)
+    status = bytes(reader.bytes(1))
+    path = reader.string()
+    entries = []
+    if status == b"0":
+        for index in range(reader.u32()):
+            entries.append(ListEntry(reader.string(), reader.u32(), reader.u64(), bytes(reader.bytes(hash_length))))
+    return status, path, entries
+
+def decode_search(answer):
+    """Return the status and the SearchResult of each page found of an answer to a search message"""
+    reader = Reader(answer)
+    status = bytes(reader.bytes(1))
+    results = []
+    if status == b"0":
+        for index in range(reader.u16()):
+            results.append(SearchResult(reader.string(), reader.u32() / 1000, reader.string()))
+    return status, results
+
+def decode_keep_alive(answer):
+    """Return the idle timeout granted"""
+    return Reader(answer).u16()
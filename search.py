@@ -0,0 +1,148 @@
+# Full-text search for the Markdown Page server
+# Thomas Führinger, 2022, https://github.com/thomasfuhringer/MarkdownPage
+
+"""
+Inverted index of the words in Text.md and Data.yml of every page of a site, and in the page names.
+It is brought up to date incrementally from the site index, only pages whose files have changed are read
+again, and saved to disk so that a restarted server does not read the whole site again.
+"""
+
+import os, re, math, pickle, threading
+
+indexed_files = ("Text.md", "Data.yml")
+word_pattern = re.compile(r"\w+")
+k1 = 1.2 # BM25 saturation of the term frequency
+b = 0.75 # BM25 normalization by page length
+snippet_length = 160 # characters around the first match
+
+def words(text):
+    return word_pattern.findall(text.casefold())
+
+class SearchIndex(object):
+    """Word -> pages posting lists with BM25 ranking. In a process which does not write the file it is only
+    read again from it when it has changed, see server.Prefork."""
+
+    def __init__(self, site_index, path, writer=True):
+        self.site_index = site_index
+        self.path = path
+        self.writer = writer
+        self.documents = {} # relative path -> (status of the indexed files, number of words, word -> count)
+        self.postings = {} # word -> {relative path: count}
+        self.words = 0 # in all pages, for the average length
+        self.loaded = None # modification time of the file when it was read
+        self.lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        try:
+            self.loaded = os.stat(self.path).st_mtime_ns
+            with open(self.path, "rb") as file:
+                documents = pickle.load(file)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return
+        postings = {}
+        for relative, (status, length, counts) in documents.items():
+            for word, count in counts.items():
+                postings.setdefault(word, {})[relative] = count
+        with self.lock:
+            self.documents = documents
+            self.postings = postings
+            self.words = sum(document[1] for document in documents.values())
+
+    def save(self):
+        with open(self.path + ".tmp", "wb") as file:
+            pickle.dump(self.documents, file)
+        os.replace(self.path + ".tmp", self.path)
+
+    def status(self, node):
+        return tuple((name, node.files[name]) for name in indexed_files if name in node.files)
+
+    def read(self, relative, status):
+        text = relative.replace("/", " ")
+        for name, file_status in status:
+            try:
+                with open(os.path.join(self.site_index.path, relative, name), encoding="utf-8", errors="replace") as file:
+                    text += "\n" + file.read()
+            except OSError: # removed meanwhile, the next update sees it
+                pass
+        counts = {}
+        for word in words(text):
+            counts[word] = counts.get(word, 0) + 1
+        return counts
+
+    def update(self):
+        """Index the pages which have changed since the last update; return their number."""
+        if not self.writer:
+            try:
+                if os.stat(self.path).st_mtime_ns != self.loaded:
+                    self.load()
+            except OSError:
+                pass
+            return 0
+        nodes = dict(self.site_index.nodes)
+        changed = 0
+        for relative, node in nodes.items():
+            status = self.status(node)
+            document = self.documents.get(relative)
+            if document is None or document[0] != status:
+                counts = self.read(relative, status)
+                with self.lock:
+                    self.remove(relative)
+                    self.documents[relative] = (status, sum(counts.values()), counts)
+                    self.words += self.documents[relative][1]
+                    for word, count in counts.items():
+                        self.postings.setdefault(word, {})[relative] = count
+                changed += 1
+        for relative in [relative for relative in self.documents if relative not in nodes]:
+            with self.lock:
+                self.remove(relative)
+            changed += 1
+        if changed:
+            self.save()
+        return changed
+
+    def remove(self, relative):
+        document = self.documents.pop(relative, None)
+        if document is None:
+            return
+        self.words -= document[1]
+        for word in document[2]:
+            pages = self.postings.get(word)
+            if pages is not None:
+                pages.pop(relative, None)
+                if not pages:
+                    del self.postings[word]
+
+    def search(self, query, limit=20):
+        """Return up to limit (relative path, score, snippet) of the pages best matching the words of the query."""
+        query_words = list(dict.fromkeys(words(query)))
+        scores = {}
+        with self.lock:
+            count = len(self.documents)
+            average = self.words / count if count else 0
+            for word in query_words:
+                pages = self.postings.get(word, {})
+                idf = math.log(1 + (count - len(pages) + 0.5) / (len(pages) + 0.5))
+                for relative, frequency in pages.items():
+                    length = self.documents[relative][1]
+                    scores[relative] = scores.get(relative, 0) + \
+                        idf * frequency * (k1 + 1) / (frequency + k1 * (1 - b + b * length / average))
+        ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:limit]
+        return [(relative, score, self.snippet(relative, query_words)) for relative, score in ranked]
+
+    def snippet(self, relative, query_words):
+        """Return the text around the first word of the query found in the page."""
+        try:
+            with open(os.path.join(self.site_index.path, relative, "Text.md"), encoding="utf-8", errors="replace") as file:
+                text = file.read()
+        except OSError:
+            return ""
+        position = len(text)
+        for word in query_words:
+            match = re.search(r"\b" + re.escape(word) + r"\b", text, re.IGNORECASE)
+            if match is not None:
+                position = min(position, match.start())
+        if position == len(text):
+            position = 0
+        start = max(0, position - snippet_length // 4)
+        return " ".join(text[start:start + snippet_length].split())
@@ -4,31 +4,211 @@
 """
 Protocol:
 
-bytes
+Every message is framed as
  4	message length
  2	identifier (0x06, 0x0E)
- 1	message type (unused)
+ 1	message type
+
+Query (0x00):
+ 2	path length
+ n	path
+
+Keep alive (0x01), sent as the first message of a connection to keep it open for further queries:
+ no payload; the server answers with message type 0x01 and
+ 2	idle timeout in seconds, after which it closes the connection
+Servers which do not know the message answer with any other type and close the connection.
+
+Query if modified (0x02), for a page the client holds already:
+ 2	path length
+ n	path
+ 32	version of the page the client holds
+
+Streamed query (0x03), for large pages: like query if modified, the version may be left out.
+ If the page is found and has been modified the server answers with message type 0x03 and
+ 1	status "0"
+ n	path, subpages and version as in the response to a query
+ followed by the page in chunks, unframed, as the server produces it:
+ 4	chunk length
+ n	chunk of the page (zipped)
+ ...
+ 4	0, end of page
+ Otherwise it sends a response to a query.
+
+List (0x04), metadata of a page and its subpages without the archives:
+ 2	path length
+ n	path
+ 1	depth, 0 for the page alone, 1 with its subpages, ...
+The server answers with message type 0xFF and
+ 1	status ("0" found, "4" not found; then only the path follows)
+ 2	path length
+ n	path
+ 4	number of pages
+ 2	length of the path of page 1 relative to the page asked for, "" for the page itself
+ n	relative path of page 1
+ 4	time stamp of page 1 in Julian minutes
+ 8	size of the files of page 1
+ 32	hash of the names and contents of the files of page 1
+ ...
+
+Search (0x06), for the pages whose text, data or name contain words:
+ 2	length of the words
+ n	words
+ 1	maximum number of results (optional, 20)
+The server answers with message type 0xFF and
+ 1	status ("0", "4" if the server does not search; then only an empty path follows)
+ 2	number of results, best match first
+ 2	path length of result 1
+ n	path of result 1
+ 4	score of result 1 in thousandths
+ 2	length of snippet 1
+ n	snippet 1, text of the page around the first match
+ ...
+
+Statistics (0xFE), for administrators:
+ no payload; the server answers with message type 0xFE and
+ n	counters, histograms of the time spent in each phase and the slowest pages as UTF-8 JSON
+
+Delta query (0x05), for a page the client holds already, to receive only the files which differ:
+ 2	path length
+ n	path
+ 32	version of the page the client holds
+ 2	number of files the client holds
+ 2	length of file name 1
+ n	file name 1
+ 32	SHA-256 hash of the content of file 1
+ ...
+The server answers with a response to a query or, if the page has been modified, with status "1":
+ 1	status "1"
+ 4	length of the delta
+ n	delta, zipped like a page, with the files which are new or have changed
+ 2	number of files removed
+ 2	length of the name of removed file 1
+ n	name of removed file 1
+ ...
+ n	path, subpages and version as in the response to a query
+ If the files which differ are larger than the stream threshold the server answers with message type 0x03, status
+ "1" and the rest as above without the length of the delta and the delta, followed by the delta in chunks as the
+ page of a streamed query.
+
+Query with blobs (0x07), for a page the client does not hold, from a client which keeps attachments by their hash:
+like a streamed query. If the page has attachments of blob size which are not too large altogether the server
+leaves them out and answers with status "2":
+ 1	status "2"
  4	page length
- n	page (zipped)
+ n	page (zipped) without the attachments left out
+ 2	number of attachments left out
+ 2	length of the name of attachment 1
+ n	name of attachment 1
+ 32	SHA-256 hash of the content of attachment 1
+ 8	size of attachment 1
+ ...
+ n	path, subpages and version as in the response to a query
+Otherwise it answers as to a streamed query.
+
+Blobs (0x08), for attachments left out of a page which the client does not hold:
+ 2	path length
+ n	path of the page
+ 2	number of attachments
+ 2	length of the name of attachment 1
+ n	name of attachment 1
+ 32	SHA-256 hash of the content of attachment 1
+ ...
+The server answers with message type 0xFF and
+ 1	status ("0", "4" if the page is not found; then only the path follows)
+ 2	number of attachments sent, those which have changed since are left out
+ 32	hash of attachment 1
+ 1	compression of attachment 1, 0 stored or 8 deflated (raw, as in zip)
+ 8	size of attachment 1
+ 4	length of the data of attachment 1
+ n	data of attachment 1
+ ...
+
+Bundle (0x09), for a page with its subpages down to a depth in one answer:
+ 2	path length
+ n	path
+ 1	depth, 0 for the page alone, 1 with its subpages, ...
+ 8	bytes of pages the client takes at most, 0 for as many as the server sends (optional)
+ 2	number of pages the client holds (optional)
+ 2	length of the path of page 1 relative to the page asked for, "" for the page itself
+ n	relative path of page 1
+ 32	version of page 1 the client holds
+ ...
+If the page is found the server answers with message type 0x09 and
+ 1	status "0"
+ 2	path length
+ n	path
+followed by a response to a query, framed as a message, for each page, breadth first, with status "3" for those
+the client holds in their current version and status "2" for those whose attachments of blob size are left out as
+for a query with blobs, to be asked for with a blobs message:
+ 4	message length
+ n	response to a query for page 1
+ ...
+ 4	0, end of bundle
+Pages of streamed size and pages which would pass the limit are left out, the client queries them by themselves.
+Otherwise it sends a response to a query with status "4".
+
+Response to a query (message type 0xFF):
+ 1	status ("0" found, "3" not modified, "4" not found; then only the path follows)
+ 4	page length (not with "3")
+ n	page (zipped, not with "3")
  2	path length
  n	path
  2	number of subpages
  2	length of subpage name 1
  n	subpage name 1
- 2	length of subpage name 2
- n	subpage name 2
+ 4	time stamp of subpage 1 in Julian minutes, latest change of its directory or files
+ ...
+ 32	version of the page, changes whenever one of its files does
+
+Busy (message type 0xFF), in place of the answer to the first message of a connection when the server has as
+many sessions as it takes, in all or from the address of the client; the connection is closed then:
+ 1	status "5"
  """
 
-import socket, threading, time, zipfile, io, os
+import socket, threading, zipfile, zlib, io, os, collections, asyncio, concurrent.futures, argparse, pickle, shutil, time, hashlib, datetime, json
+import multiprocessing
+import search, protocol
+from protocol import identifier, MessageType, frame, frame_parts, path_field, names_field
 
 default_host = "localhost"
 default_port = 1550
-identifier = bytes([0x06, 0x0E])
-
-class MessageType:
-    Query = b'0x00',
-    ShutDown = b'0xFF'
-
+default_cache_size = 64 * 1024 * 1024 # bytes of finished responses kept in memory
+default_backlog = 128
+default_connections = 256 # sessions served at once in asyncio mode
+default_workers = 8 # threads building pages in asyncio mode
+default_processes = 1 # processes accepting connections, more to use more cores for zipping
+halt_poll_interval = 1 # seconds after which the processes of a server notice that one of them was shut down
+shutdown_timeout = 30 # seconds the responses under way get to be completed when the server is shut down
+default_idle_timeout = 30 # seconds a kept alive connection may wait for the next query
+default_read_timeout = 10 # seconds a client may take to send a query, however slowly the bytes come
+default_write_timeout = 30 # seconds a client may take to accept a response, beyond the time its bytes take at min_write_rate
+min_write_rate = 64 * 1024 # bytes per second a client must accept on average, a slower one loses its session
+write_chunk_size = 1024 * 1024
+default_max_sessions = 512 # sessions served at once, more connections are answered busy
+default_max_sessions_per_address = 64 # sessions of one client address served at once
+max_query_size = 4 * 1024 * 1024 # bytes, a delta query with the hashes of many files is the longest
+default_blob_threshold = 16 * 1024 # bytes of an attachment from which it is sent by hash to clients with a blob store
+max_blobs_size = 32 * 1024 * 1024 # bytes of attachments sent in the answer to one blobs message at most
+max_bundle_size = 64 * 1024 * 1024 # bytes of pages sent in the answer to one bundle message at most
+page_files = ("Text.md", "Data.yml", "Code.py", "Code.pyd") # the other files of a page are attachments
+reject_linger = 1 # seconds a connection answered busy stays open for the client to read the answer
+max_lingering = 64 # connections answered busy which linger at once in threaded mode, more are closed at once
+default_site_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), "Site")
+default_store_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), "Store")
+default_search_directory = os.path.dirname(os.path.realpath(__file__)) # for the search index of each site
+default_search_results = 20
+default_rebuild_interval = 5 # seconds between checks of the site for changes to rebuild
+default_index_interval = 2 # seconds between scans of the site for changes
+default_stat_interval = 30 # seconds between checks of the files of unchanged directories for changes made in place
+default_compress_level = 6 # zlib level for files that are worth deflating
+stored_extensions = {".jpg", ".jpeg", ".png", ".gif", ".webp", ".mdp", ".zip", ".gz", ".bz2", ".xz", ".7z",
+                     ".mp3", ".ogg", ".mp4", ".webm", ".docx", ".xlsx", ".pptx", ".odt"} # already compressed, stored as is
+probe_size = 64 * 1024 # bytes of other files compressed on trial to decide whether to deflate them
+default_stream_threshold = 8 * 1024 * 1024 # bytes of files from which a streamed page is zipped straight onto the socket
+stream_chunk_size = 64 * 1024
+default_stats_interval = 60 # seconds between lines written to the statistics log
+histogram_bounds = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10) # seconds
+slowest_pages = 10 # pages listed in the statistics
 def JDN(gregorian):
     """Convert the given proleptic Gregorian date to the equivalent Julian Day Number."""
     A = int((gregorian.month - 14) / 12)
@@ -37,135 +217,1396 @@ def JDN(gregorian):
     E = int((gregorian.year + 4900 + A) / 100)
     return int(B / 4) + int(C / 12) - int(3 * E / 4) + gregorian.day - 32075
 
-def JSN(gregorian): # Julian Second Number
-    return JDN(gregorian) * 1440 + (gregorian.hour * 60) + gregorian.second
+def JSN(gregorian): # Julian minute number
+    return JDN(gregorian) * 1440 + (gregorian.hour * 60) + gregorian.minute
+
+def time_stamp(mtime_ns):
+    """Return a file modification time in Julian minutes."""
+    return JSN(datetime.datetime.fromtimestamp(mtime_ns / 1e9, datetime.timezone.utc))
+
+def modified(file_path):
+    """Return the latest modification time of a page directory and its files."""
+    latest = os.stat(file_path).st_mtime_ns
+    with os.scandir(file_path) as iterator:
+        for entry in iterator:
+            if entry.is_file():
+                latest = max(latest, entry.stat().st_mtime_ns)
+    return latest
+
+def page_signature(file_path):
+    """Stat the page directory and its entries; any change to the page changes the signature."""
+    signature = [os.stat(file_path).st_mtime_ns]
+    with os.scandir(file_path) as iterator:
+        for entry in iterator:
+            status = entry.stat()
+            signature.append((entry.name, entry.is_dir(), status.st_mtime_ns, status.st_size))
+    signature.sort(key=str)
+    return tuple(signature)
+
+def search_index_path(site_path):
+    """Return the default file of the search index of a site, named after its path so that sites do not share one."""
+    digest = hashlib.sha256(os.path.realpath(site_path).encode("utf-8")).hexdigest()
+    return os.path.join(default_search_directory, "Search-{}.pickle".format(digest[:12]))
+
+def page_version(signature):
+    return hashlib.sha256(repr(signature).encode()).digest()
+
+def list_subpages(file_path):
+    """Return the subdirectories of a page directory as the subpage list sent in the response."""
+    subpages = []
+    with os.scandir(file_path) as iterator:
+        for entry in iterator:
+            if entry.is_dir():
+                subpages.append((entry.name, time_stamp(modified(entry.path))))
+    return protocol.subpages_field(subpages)
+
+def compress_type(file_path):
+    """Deflate only files which shrink; known compressed formats and files whose start does not compress are stored."""
+    if os.path.splitext(file_path)[1].lower() in stored_extensions:
+        return zipfile.ZIP_STORED
+    with open(file_path, "rb") as file:
+        sample = file.read(probe_size)
+    if len(zlib.compress(sample, 1)) > len(sample) * 0.9:
+        return zipfile.ZIP_STORED
+    return zipfile.ZIP_DEFLATED
+
+def build_archive(file_path, target, compress_level=default_compress_level, names=None):
+    """Zip the files of a page directory into target, or only those with the names given."""
+    with zipfile.ZipFile(target, "w") as zip_file:
+        with os.scandir(file_path) as iterator:
+            for entry in iterator:
+                if entry.is_file() and (names is None or entry.name in names):
+                    entry_path = os.path.join(file_path, entry.name)
+                    zip_file.write(entry_path, entry.name, compress_type(entry_path), compress_level)
+
+class PageCache(object):
+    """Finished responses keyed by resolved directory, evicted least recently used first."""
+
+    def __init__(self, size=default_cache_size):
+        self.size = size
+        self.used = 0
+        self.entries = collections.OrderedDict() # directory -> (signature, response)
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, directory, signature):
+        with self.lock:
+            entry = self.entries.get(directory)
+            if entry is None:
+                return None
+            if entry[0] != signature: # page changed on disk
+                del self.entries[directory]
+                self.used -= len(entry[1])
+                return None
+            self.entries.move_to_end(directory)
+            return entry[1]
+
+    def put(self, directory, signature, response):
+        if len(response) > self.size:
+            return
+        with self.lock:
+            entry = self.entries.pop(directory, None)
+            if entry is not None:
+                self.used -= len(entry[1])
+            self.entries[directory] = (signature, response)
+            self.used += len(response)
+            while self.used > self.size:
+                directory, entry = self.entries.popitem(last=False)
+                self.used -= len(entry[1])
+                self.evictions += 1
+
+def response_status(response):
+    """Return the status of a response: framed bytes, the buffers of one which is not cached or a response object."""
+    if isinstance(response, bytes):
+        return response[7:8]
+    if isinstance(response, list):
+        return bytes(response[1][:1])
+    return response.header[7:8]
+
+def response_size(response):
+    if isinstance(response, bytes):
+        return len(response)
+    if isinstance(response, list):
+        return sum(len(buffer) for buffer in response)
+    return response.size
+
+class WriteDeadline(object):
+    """Time by which a client must have accepted a response: the write timeout, extended by the time each part of the
+    response takes at min_write_rate, so that a client reading slowly cannot hold a session however large the page."""
+
+    def __init__(self, timeout, rate=min_write_rate):
+        self.end = time.monotonic() + timeout
+        self.rate = rate
+
+    def extend(self, count):
+        """Allow for count more bytes; return the seconds left to write them, raise socket.timeout if none are."""
+        self.end += count / self.rate
+        remaining = self.end - time.monotonic()
+        if remaining <= 0:
+            raise socket.timeout("Write deadline passed")
+        return remaining
+
+def send_data(connection, data, deadline):
+    view = memoryview(data)
+    for offset in range(0, len(view), write_chunk_size):
+        chunk = view[offset:offset + write_chunk_size]
+        connection.settimeout(deadline.extend(len(chunk))) # the total for sendall, however the bytes trickle out
+        connection.sendall(chunk)
+
+def send_file(connection, file, offset, count, deadline):
+    """Send part of a file with socket.sendfile, in write chunks so that the deadline is checked between them."""
+    end = offset + count
+    while offset < end:
+        size = min(write_chunk_size, end - offset)
+        connection.settimeout(deadline.extend(size))
+        connection.sendfile(file, offset, size)
+        offset += size
+
+async def write_data(writer, data, deadline):
+    view = memoryview(data)
+    for offset in range(0, len(view), write_chunk_size):
+        chunk = view[offset:offset + write_chunk_size]
+        writer.write(chunk)
+        await asyncio.wait_for(writer.drain(), deadline.extend(len(chunk)))
+
+async def write_file(writer, file, offset, count, deadline):
+    """Send part of a file with loop.sendfile, in write chunks each given the time left before the deadline."""
+    loop = asyncio.get_running_loop()
+    end = offset + count
+    while offset < end:
+        size = min(write_chunk_size, end - offset)
+        await asyncio.wait_for(loop.sendfile(writer.transport, file, offset, size), deadline.extend(size))
+        offset += size
+
+class StoredPage(object):
+    """Response to be sent from a prebuilt archive without copying it through user space."""
+
+    def __init__(self, archive_path, subpages, path_elements, version):
+        self.file = open(archive_path, "rb")
+        size = os.fstat(self.file.fileno()).st_size # the builder may replace the file, the open one stays intact
+        self.trailer = path_field(path_elements) + subpages + version
+        length = len(identifier) + 2 + 4 + size + len(self.trailer)
+        self.header = protocol.header.pack(length, identifier, MessageType.Response) + b"0" + protocol.u32.pack(size)
+        self.size = length + 4
+
+    def send(self, connection, deadline):
+        try:
+            send_data(connection, self.header, deadline)
+            send_file(connection, self.file, 0, os.fstat(self.file.fileno()).st_size, deadline)
+            send_data(connection, self.trailer, deadline)
+        finally:
+            self.file.close()
+
+    async def write(self, writer, executor, deadline):
+        try:
+            await write_data(writer, self.header, deadline)
+            await write_file(writer, self.file, 0, os.fstat(self.file.fileno()).st_size, deadline)
+            writer.write(self.trailer)
+        finally:
+            self.file.close()
+
+class ChunkWriter(object):
+    """Target for zipfile which passes on what is written in chunks, each preceded by its length."""
+
+    def __init__(self, send):
+        self.send = send
+        self.buffer = bytearray()
+        self.sent = 0
+
+    def write(self, data):
+        self.buffer += data
+        if len(self.buffer) >= stream_chunk_size:
+            self.flush()
+        return len(data)
+
+    def flush(self):
+        if self.buffer:
+            self.send(protocol.chunk_header(len(self.buffer)) + self.buffer)
+            self.sent += len(self.buffer) + 4
+            self.buffer = bytearray()
+
+class StreamedPage(object):
+    """Response to a streamed query; the archive comes from memory, a prebuilt file or is zipped while it is sent."""
+    max_file_chunk = 1024 * 1024 * 1024
+
+    def __init__(self, header, archive=None, file=None, directory=None, compress_level=default_compress_level, names=None):
+        self.header = frame(header, message_type=MessageType.QueryStream)
+        self.archive = archive
+        self.file = file
+        self.directory = directory
+        self.compress_level = compress_level
+        self.names = names # of the files of the directory to be zipped, all if None
+        self.size = len(self.header) + 4 # bytes sent, the archive is added while it is sent
+
+    def file_chunks(self):
+        size = os.fstat(self.file.fileno()).st_size
+        for offset in range(0, size, StreamedPage.max_file_chunk):
+            yield offset, min(StreamedPage.max_file_chunk, size - offset)
+
+    def send(self, connection, deadline):
+        send_data(connection, self.header, deadline)
+        if self.file is not None:
+            try:
+                for offset, count in self.file_chunks():
+                    send_data(connection, protocol.chunk_header(count), deadline)
+                    send_file(connection, self.file, offset, count, deadline)
+                    self.size += count + 4
+            finally:
+                self.file.close()
+        elif self.archive is not None:
+            for offset in range(0, len(self.archive), stream_chunk_size):
+                chunk = self.archive[offset:offset + stream_chunk_size]
+                send_data(connection, protocol.chunk_header(len(chunk)) + chunk, deadline)
+                self.size += len(chunk) + 4
+        else:
+            writer = ChunkWriter(lambda data: send_data(connection, data, deadline))
+            build_archive(self.directory, writer, self.compress_level, self.names)
+            self.size += writer.sent
+        send_data(connection, protocol.end_of_stream, deadline)
+
+    async def write(self, writer, executor, deadline):
+        loop = asyncio.get_running_loop()
+        writer.write(self.header)
+        if self.file is not None:
+            try:
+                for offset, count in self.file_chunks():
+                    await write_data(writer, protocol.chunk_header(count), deadline)
+                    await write_file(writer, self.file, offset, count, deadline)
+                    self.size += count + 4
+            finally:
+                self.file.close()
+        elif self.archive is not None:
+            for offset in range(0, len(self.archive), stream_chunk_size):
+                chunk = self.archive[offset:offset + stream_chunk_size]
+                await write_data(writer, protocol.chunk_header(len(chunk)) + chunk, deadline)
+                self.size += len(chunk) + 4
+        else: # zip in the thread pool, hand each chunk over to the event loop and wait until it is written
+            send = lambda data: asyncio.run_coroutine_threadsafe(write_data(writer, data, deadline), loop).result()
+            chunk_writer = ChunkWriter(send)
+            await loop.run_in_executor(executor, build_archive, self.directory, chunk_writer, self.compress_level, self.names)
+            self.size += chunk_writer.sent
+        writer.write(protocol.end_of_stream)
+
+class Bundle(object):
+    """Response to a bundle message; each page is built while the one before is sent, see Server.bundle_pages."""
+
+    def __init__(self, header, pages):
+        self.header = frame(header, message_type=MessageType.Bundle)
+        self.pages = pages # iterator of responses to queries, framed bytes or StoredPage
+        self.size = len(self.header) + 4
+
+    def send(self, connection, deadline):
+        send_data(connection, self.header, deadline)
+        for page in self.pages:
+            if isinstance(page, bytes):
+                send_data(connection, page, deadline)
+                self.size += len(page)
+            else:
+                page.send(connection, deadline)
+                self.size += page.size
+        send_data(connection, protocol.end_of_stream, deadline)
+
+    async def write(self, writer, executor, deadline):
+        loop = asyncio.get_running_loop()
+        writer.write(self.header)
+        while True:
+            page = await loop.run_in_executor(executor, next, self.pages, None)
+            if page is None:
+                break
+            if isinstance(page, bytes):
+                await write_data(writer, page, deadline)
+                self.size += len(page)
+            else:
+                await page.write(writer, executor, deadline)
+                self.size += page.size
+        writer.write(protocol.end_of_stream)
+
+class Store(object):
+    """Prebuilt page archives, one directory per page mirroring the site tree."""
+    archive_name = "Page.mdp"
+    manifest_name = "Page.idx" # signature of the source directory and subpage list
+
+    def __init__(self, site_path, path, compress_level=default_compress_level):
+        self.site_path = os.path.realpath(site_path)
+        self.path = os.path.realpath(path)
+        self.compress_level = compress_level
+        self.lock = threading.Lock() # one build at a time in a process, they share temporary file names
+
+    def target(self, file_path):
+        return os.path.normpath(os.path.join(self.path, os.path.relpath(file_path, self.site_path)))
+
+    def manifest(self, file_path):
+        try:
+            with open(os.path.join(self.target(file_path), Store.manifest_name), "rb") as file:
+                return pickle.load(file)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+
+    def build(self, file_path, signature=None):
+        """Write archive and manifest for one page; replace the files only once they are complete."""
+        if signature is None:
+            signature = page_signature(file_path)
+        target = self.target(file_path)
+        archive_path = os.path.join(target, Store.archive_name)
+        manifest_path = os.path.join(target, Store.manifest_name)
+        suffix = ".{}.tmp".format(os.getpid()) # server processes may build the same page at once
+        with self.lock:
+            os.makedirs(target, exist_ok=True)
+            with open(archive_path + suffix, "wb") as file:
+                build_archive(file_path, file, self.compress_level)
+            os.replace(archive_path + suffix, archive_path)
+            manifest = {"signature": signature, "subpages": list_subpages(file_path)}
+            with open(manifest_path + suffix, "wb") as file:
+                pickle.dump(manifest, file)
+            os.replace(manifest_path + suffix, manifest_path)
+        return manifest
+
+    def update(self):
+        """Rebuild the pages whose source has changed and drop those which are gone; return the number rebuilt."""
+        built = 0
+        for directory, subdirectories, files in os.walk(self.site_path):
+            if os.path.realpath(directory) == self.path:
+                subdirectories.clear()
+                continue
+            signature = page_signature(directory)
+            manifest = self.manifest(directory)
+            if manifest is None or manifest["signature"] != signature:
+                self.build(directory, signature)
+                built += 1
+        for directory, subdirectories, files in os.walk(self.path, topdown=False):
+            source = os.path.join(self.site_path, os.path.relpath(directory, self.path))
+            if not os.path.isdir(source):
+                shutil.rmtree(directory, ignore_errors=True)
+        return built
+
+    def page(self, file_path, path_elements, subpages=None, version=None, stream=False):
+        """Return the response for a page; the subpage list may be given with more recent time stamps than the manifest's."""
+        manifest = self.manifest(file_path)
+        if manifest is None: # not built yet
+            manifest = self.build(file_path)
+        if subpages is None:
+            subpages = manifest["subpages"]
+        current_version = page_version(manifest["signature"])
+        if version == current_version:
+            return frame(b"3" + path_field(path_elements) + subpages + current_version)
+        archive_path = os.path.join(self.target(file_path), Store.archive_name)
+        if stream:
+            return StreamedPage(b"0" + path_field(path_elements) + subpages + current_version, file=open(archive_path, "rb"))
+        return StoredPage(archive_path, subpages, path_elements, current_version)
+
+class IndexNode(object):
+    def __init__(self, children, files, mtime):
+        self.children = children # names of the subdirectories in directory order
+        self.files = files # name -> (modification time, size)
+        self.mtime = mtime # of the directory, changes when entries are added, removed or renamed
+        self.folded = {}
+        for name in reversed(children):
+            self.folded[name.casefold()] = name # first match wins, as with a scan
+        self.modified = max([mtime] + [status[0] for status in files.values()])
+        self.size = sum(status[1] for status in files.values())
+        self.subpages = None # (generation of the index, subpage list), made when first asked for
+
+class SiteIndex(object):
+    """Directory tree of the site held in memory, so that resolving a path and listing subpages do not touch the disk."""
+
+    def __init__(self, path, stat_interval=default_stat_interval):
+        self.path = path
+        self.nodes = {} # relative path with "/" separators -> IndexNode; nodes are replaced, never changed
+        self.generation = 0 # counts updates which changed something
+        self.hashes = {} # (relative path, file name) -> (modification time, size, hash of the content)
+        self.stat_interval = stat_interval
+        self.statted = time.monotonic() # when the files were last checked
+        self.update()
+
+    def scan(self, directory):
+        children = []
+        files = {}
+        with os.scandir(directory) as iterator:
+            for entry in iterator:
+                if entry.is_dir():
+                    children.append(entry.name)
+                elif entry.is_file():
+                    status = entry.stat()
+                    files[entry.name] = (status.st_mtime_ns, status.st_size)
+        return IndexNode(children, files, os.stat(directory).st_mtime_ns)
+
+    def restat(self, directory, node):
+        """Return the node with the status of its files read again, for changes which leave the directory as it is."""
+        files = {}
+        for name in node.files:
+            try:
+                status = os.stat(os.path.join(directory, name))
+            except OSError: # removed, the directory is scanned again next time
+                continue
+            files[name] = (status.st_mtime_ns, status.st_size)
+        return IndexNode(node.children, files, node.mtime)
+
+    def update(self):
+        """Scan the directories whose modification time has changed, and at the stat interval check the files of the
+        others; return the number of directories which have changed."""
+        changed = 0
+        seen = set()
+        pending = [""]
+        restat = time.monotonic() - self.statted >= self.stat_interval
+        if restat:
+            self.statted = time.monotonic()
+        while pending:
+            relative = pending.pop()
+            directory = os.path.join(self.path, relative)
+            current = self.nodes.get(relative)
+            try:
+                if current is None or os.stat(directory).st_mtime_ns != current.mtime:
+                    node = self.scan(directory)
+                elif restat:
+                    node = self.restat(directory, current)
+                else:
+                    node = current
+            except OSError: # removed meanwhile
+                continue
+            if current is None or current.children != node.children or current.files != node.files or current.modified != node.modified:
+                self.nodes[relative] = node
+                changed += 1
+            seen.add(relative)
+            pending += [relative + "/" + name if relative else name for name in node.children]
+        for relative in list(self.nodes):
+            if relative not in seen:
+                self.nodes.pop(relative, None)
+                changed += 1
+        if changed:
+            self.generation += 1
+            self.hashes = {key: known for key, known in list(self.hashes.items()) # of files which are gone
+                           if key[0] in self.nodes and key[1] in self.nodes[key[0]].files}
+        return changed
+
+    def resolve(self, path):
+        """Map a query path onto the relative path of a page; the lookup is case insensitive if there is no exact match.
+        Return None and the path elements up to the first one not found if there is no such page."""
+        relative = ""
+        path_elements = []
+        for requested in path.split("/"):
+            if requested == "":
+                continue
+            node = self.nodes.get(relative)
+            if node is None:
+                return None, path_elements + [requested]
+            directory = requested
+            if directory not in node.children:
+                directory = node.folded.get(requested.casefold())
+                if directory is None:
+                    return None, path_elements + [requested]
+            path_elements.append(directory)
+            relative = "/".join(path_elements)
+        if relative not in self.nodes:
+            return None, path_elements
+        return relative, path_elements
+
+    def subpages(self, relative):
+        """Return the subpage list of a page with the time stamps of the subpages, or None if there is no such page."""
+        node = self.nodes.get(relative)
+        if node is None:
+            return None
+        generation = self.generation
+        if node.subpages is None or node.subpages[0] != generation:
+            subpages = []
+            for name in node.children:
+                child = self.nodes.get(relative + "/" + name if relative else name)
+                subpages.append((name, time_stamp(child.modified) if child else 0))
+            node.subpages = (generation, protocol.subpages_field(subpages))
+        return node.subpages[1]
+
+    def file_hash(self, relative, name, status=None):
+        """Return the hash of the content of a file, read again only if it has changed since.
+        The modification time and size may be given if they are more recent than those in the index."""
+        if status is None:
+            status = self.nodes[relative].files[name]
+        known = self.hashes.get((relative, name))
+        if known is None or known[:2] != status:
+            digest = hashlib.sha256()
+            with open(os.path.join(self.path, relative, name), "rb") as file:
+                for block in iter(lambda: file.read(1024 * 1024), b""):
+                    digest.update(block)
+            known = status + (digest.digest(),)
+            self.hashes[(relative, name)] = known
+        return known[2]
+
+    def content_hash(self, relative, files=None):
+        """Return a hash over the names and contents of the files of a page; files may give their modification times
+        and sizes if they are more recent than those in the index."""
+        if files is None:
+            files = self.nodes[relative].files
+        digest = hashlib.sha256()
+        for name in sorted(files):
+            digest.update(protocol.field(bytes(name, "utf-8")) + self.file_hash(relative, name, files[name]))
+        return digest.digest()
+
+    def list_pages(self, relative, depth):
+        """Return the number of pages and their metadata as sent in the response to a list message, breadth first.
+        The files of each page listed are checked again, so that the list never lags behind a query."""
+        entries = []
+        pending = collections.deque([(relative, "", 0)])
+        while pending:
+            page_relative, name, level = pending.popleft()
+            node = self.nodes.get(page_relative)
+            if node is None:
+                continue
+            current = self.restat(os.path.join(self.path, page_relative), node) # a file edited in place, as a query would see it
+            entries.append(protocol.ListEntry(name, time_stamp(current.modified), current.size, self.content_hash(page_relative, current.files)))
+            if level < depth:
+                for child in node.children:
+                    pending.append((page_relative + "/" + child if page_relative else child, name + "/" + child if name else child, level + 1))
+        return protocol.list_entries_field(entries)
+
+class Updater(threading.Thread):
+    """Brings an index or store up to date with the site at an interval in the background."""
+
+    def __init__(self, target, interval, report):
+        threading.Thread.__init__(self, daemon=True)
+        self.target = target
+        self.interval = interval
+        self.report = report
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                updated = self.target.update()
+                if updated:
+                    print(self.report.format(updated))
+            except OSError as e:
+                print("Update failed: " + str(e))
+
+class Histogram(object):
+    """Counts of observations in buckets with the upper bounds given; the last bucket takes the rest."""
+
+    def __init__(self, bounds=histogram_bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.total = 0
+        self.maximum = 0
+
+    def add(self, value):
+        index = 0
+        while index < len(self.bounds) and value > self.bounds[index]:
+            index += 1
+        self.counts[index] += 1
+        self.total += value
+        self.maximum = max(self.maximum, value)
+
+    def snapshot(self):
+        count = sum(self.counts)
+        buckets = {"<={}".format(bound): count for bound, count in zip(self.bounds, self.counts)}
+        buckets[">{}".format(self.bounds[-1])] = self.counts[-1]
+        return {"count": count, "mean": self.total / count if count else 0, "max": self.maximum, "buckets": buckets}
+
+class Stats(object):
+    """Counters and timings of the requests served, shared by all sessions."""
+
+    def __init__(self):
+        self.started = time.time()
+        self.counters = collections.Counter()
+        self.histograms = collections.defaultdict(Histogram) # phase -> seconds
+        self.pages = {} # relative path -> [requests, seconds constructing, most seconds], for finding slow directories
+        self.lock = threading.Lock()
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] += value
+
+    def time(self, phase, seconds):
+        with self.lock:
+            self.histograms[phase].add(seconds)
+
+    def page(self, relative, seconds):
+        with self.lock:
+            entry = self.pages.setdefault(relative, [0, 0, 0])
+            entry[0] += 1
+            entry[1] += seconds
+            entry[2] = max(entry[2], seconds)
+
+    def snapshot(self, cache=None):
+        with self.lock:
+            counters = dict(self.counters)
+            counters["sessions_active"] = counters.get("sessions_opened", 0) - counters.get("sessions_closed", 0)
+            if cache is not None:
+                counters["cache_evictions"] = cache.evictions
+                counters["cache_bytes"] = cache.used
+                counters["cache_entries"] = len(cache.entries)
+            slowest = sorted(self.pages.items(), key=lambda item: item[1][1], reverse=True)[:slowest_pages]
+            return {"time": time.time(), "uptime": time.time() - self.started, "process": os.getpid(), "counters": counters,
+                    "seconds": {phase: histogram.snapshot() for phase, histogram in self.histograms.items()},
+                    "slowest_pages": [{"path": relative, "requests": entry[0], "seconds": entry[1], "max": entry[2]} for relative, entry in slowest]}
+
+class StatsLog(object):
+    """Appends the statistics of a server to a file as one line of JSON each time it is updated, see Updater."""
+
+    def __init__(self, server, path):
+        self.server = server
+        self.path = path
+
+    def update(self):
+        with open(self.path, "a", encoding="utf-8") as file:
+            file.write(json.dumps(self.server.stats.snapshot(self.server.cache)) + "\n")
+        return 0
+
+def listen(host, port, backlog):
+    listener = socket.socket()
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind((host, port))
+    listener.listen(backlog)
+    return listener
 
 class Server(object):
-    backlog = 5
+    """Accepts connections and runs each session in its own thread."""
 
-    def __init__(self, host=default_host, port=default_port):
+    def __init__(self, host=default_host, port=default_port, cache_size=default_cache_size, backlog=default_backlog,
+                 idle_timeout=default_idle_timeout, site_path=default_site_path, store_path=None,
+                 rebuild_interval=default_rebuild_interval, compress_level=default_compress_level,
+                 index_interval=default_index_interval, stat_interval=default_stat_interval, stream_threshold=default_stream_threshold,
+                 stats_log=None, stats_interval=default_stats_interval, search_path="",
+                 read_timeout=default_read_timeout, write_timeout=default_write_timeout, max_sessions=default_max_sessions,
+                 max_sessions_per_address=default_max_sessions_per_address, blob_threshold=default_blob_threshold,
+                 listener=None, halt=None):
+        """A listening socket and an event which stops all processes sharing it are given when run by Prefork,
+        which keeps the store and the search index up to date then; the limits of sessions apply to each process.
+        The search index is kept in search_path, see search_index_path if it is "", and None turns search off."""
         self.sessions = []
-        self.socket = socket.socket()
-        self.socket.bind((host, port))
-        self.socket.listen(Server.backlog)
+        self.read_timeout = read_timeout
+        self.write_timeout = write_timeout
+        self.max_sessions = max_sessions
+        self.max_sessions_per_address = max_sessions_per_address
+        self.active = collections.Counter() # client address -> sessions
+        self.admission = threading.Lock()
+        self.lingering = threading.BoundedSemaphore(max_lingering) # threads of connections answered busy
+        self.cache = PageCache(cache_size)
+        self.stats = Stats()
+        self.backlog = backlog
+        self.idle_timeout = idle_timeout
+        self.compress_level = compress_level
+        self.stream_threshold = stream_threshold
+        self.blob_threshold = blob_threshold
+        self.socket = listener if listener is not None else listen(host, port, backlog)
+        self.halt = halt
         self.up = True
-        self.path = os.path.join(os.path.dirname(os.path.realpath(__file__)), "Site")
-        print("Markdown Page server running on host '{}', port {}.".format(host, port))
+        self.path = os.path.realpath(site_path)
+        if search_path == "":
+            search_path = search_index_path(self.path)
+        self.index = SiteIndex(self.path, stat_interval)
+        Updater(self.index, index_interval, "Reindexed {} directories.").start()
+        self.search = None
+        if search_path is not None:
+            self.search = search.SearchIndex(self.index, search_path, writer=listener is None)
+            if listener is None:
+                print("Indexed {} page(s) for search.".format(self.search.update()))
+            Updater(self.search, index_interval, "Indexed {} page(s) for search.").start()
+        self.store = None
+        if store_path is not None:
+            self.store = Store(self.path, store_path, compress_level)
+            if listener is None:
+                print("Built {} page(s).".format(self.store.update()))
+                Updater(self.store, rebuild_interval, "Rebuilt {} page(s).").start()
+        if stats_log is not None:
+            Updater(StatsLog(self, stats_log), stats_interval, "").start()
+        if listener is None:
+            print("Markdown Page server running on host '{}', port {}.".format(host, port))
 
     def run(self):
+        if self.halt is not None: # wake up now and then to see whether another process was shut down
+            self.socket.settimeout(halt_poll_interval)
 
         while self.up:
-            (clientsocket, address) = self.socket.accept()
+            try:
+                (clientsocket, address) = self.socket.accept()
+            except socket.timeout:
+                if self.halt.is_set():
+                    break
+                continue
+            except BlockingIOError: # another process took the connection
+                continue
+            if not self.admit(address):
+                self.reject(clientsocket)
+                continue
             session = Session(clientsocket, address, self)
-            self.sessions += [session]
+            self.sessions = [session for session in self.sessions if session.is_alive()]
+            self.sessions.append(session)
             session.start()
-            time.sleep(1)
 
+        if self.halt is not None: # shared with the other processes
+            self.socket.close()
+            self.finish()
+            return
         try:
             self.socket.shutdown(socket.SHUT_RDWR)
             self.socket.close()
         except Exception as e:
             pass
+        self.finish()
 
         print("Server halted.")
 
+    def finish(self):
+        """Wait up to the shutdown timeout for the sessions to complete the responses under way; sessions waiting for
+        a query end at once."""
+        sessions = [session for session in self.sessions if session.is_alive()]
+        for session in sessions:
+            try: # a receive returns as if the client had closed, a send goes on
+                session.socket.shutdown(socket.SHUT_RD)
+            except OSError:
+                pass
+        deadline = time.monotonic() + shutdown_timeout
+        for session in sessions:
+            session.join(max(0, deadline - time.monotonic()))
+
+    def stop(self):
+        if self.halt is not None:
+            self.halt.set() # first, the process must not end while it holds the lock of the event
+            self.up = False # the accept loop notices it by itself
+            return
+        self.up = False
+        try: # wake up the accept loop
+            socket.create_connection(self.socket.getsockname()).close()
+        except OSError:
+            pass
+
+    def admit(self, address):
+        """Count a session of the client address; return False if there are as many as allowed already."""
+        with self.admission:
+            if sum(self.active.values()) >= self.max_sessions or self.active[address[0]] >= self.max_sessions_per_address:
+                return False
+            self.active[address[0]] += 1
+            return True
+
+    def release(self, address):
+        with self.admission:
+            self.active[address[0]] -= 1
+            if self.active[address[0]] <= 0:
+                del self.active[address[0]]
+
+    def reject(self, connection):
+        """Answer busy on a short-lived thread which waits for the client, so the accept loop goes on at once."""
+        self.stats.count("sessions_rejected")
+        if self.lingering.acquire(blocking=False):
+            threading.Thread(target=self.linger, args=(connection,), daemon=True).start()
+            return
+        try: # too many at once, answer without waiting
+            connection.setblocking(False)
+            try: # what has arrived of the query, closing with it unread would reset the connection before the answer is read
+                connection.recv(stream_chunk_size)
+            except OSError:
+                pass
+            connection.send(frame(b"5"))
+            connection.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
+        connection.close()
+
+    def linger(self, connection):
+        """Send the busy answer and read what the client sends until it closes, up to reject_linger; closing with its
+        query unread, which usually arrives after the answer, would reset the connection before the answer is read."""
+        try:
+            deadline = time.monotonic() + reject_linger
+            connection.settimeout(reject_linger)
+            connection.sendall(frame(b"5"))
+            connection.shutdown(socket.SHUT_WR)
+            while connection.recv(stream_chunk_size):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                connection.settimeout(remaining)
+        except OSError:
+            pass
+        finally:
+            connection.close()
+            self.lingering.release()
+
+    def keep_alive(self):
+        return frame(protocol.u16.pack(self.idle_timeout), message_type=MessageType.KeepAlive)
+
+    def stats_response(self):
+        return frame(json.dumps(self.stats.snapshot(self.cache)).encode("utf-8"), message_type=MessageType.Stats)
+
+    def respond(self, query):
+        """Return the framed response to a query message."""
+        started = time.perf_counter()
+        try:
+            message_type, path, reader = protocol.decode_request(query)
+            if message_type == MessageType.List:
+                response = self.list_pages(path, 0 if reader.at_end() else reader.u8())
+            elif message_type == MessageType.Search:
+                response = self.search_pages(path.decode("utf-8", "replace"), default_search_results if reader.at_end() else reader.u8())
+            elif message_type == MessageType.QueryDelta:
+                response = self.construct_delta(path, bytes(reader.bytes(protocol.version_length)), protocol.decode_hashes(reader))
+            elif message_type == MessageType.Blobs:
+                response = self.send_blobs(path, protocol.decode_hashes(reader))
+            elif message_type == MessageType.Bundle:
+                depth = 0 if reader.at_end() else reader.u8()
+                limit = 0 if reader.at_end() else reader.u64()
+                response = self.construct_bundle(path, depth, limit, protocol.decode_hashes(reader))
+            else:
+                version = None
+                if message_type in (MessageType.QueryIfModified, MessageType.QueryStream, MessageType.QueryBlobs):
+                    version = bytes(reader.bytes(protocol.version_length)) or None
+                response = self.construct_page(path, version, message_type in (MessageType.QueryStream, MessageType.QueryBlobs),
+                                               message_type == MessageType.QueryBlobs)
+        except Exception:
+            self.stats.count("errors")
+            raise
+        self.stats.count("requests")
+        self.stats.count("status_" + response_status(response).decode())
+        self.stats.time("respond", time.perf_counter() - started)
+        return response
+
+    def sent(self, response, started):
+        """Account for a response sent since the time given."""
+        self.stats.count("bytes_sent", response_size(response))
+        self.stats.time("send", time.perf_counter() - started)
+
+    def resolve(self, path):
+        """Map a query path onto a directory of the site; return None for the directory if there is none."""
+        relative, path_elements = self.index.resolve(path.decode())
+        if relative is None:
+            return None, path_elements
+        return os.path.join(self.path, *path_elements), path_elements
+
+    def construct_page(self, path, version=None, stream=False, blobs=False):
+        """Return the framed response for the page at path, from the cache if it is still current.
+        If the client holds the current version already only the path and subpages are sent.
+        For a streamed query return a StreamedPage; large pages are not built in memory for it.
+        For a query with blobs the attachments of blob size are left out if that is possible."""
+        started = time.perf_counter()
+        file_path, path_elements = self.resolve(path)
+        if file_path is None:
+            return frame(b"4" + path_field(path_elements))
+
+        subpages = self.index.subpages("/".join(path_elements))
+        if subpages is None: # removed since resolved
+            return frame(b"4" + path_field(path_elements))
+        resolved = time.perf_counter()
+        self.stats.time("resolve", resolved - started)
+        try:
+            return self.build_response(file_path, path_elements, subpages, version, stream, blobs)
+        finally:
+            elapsed = time.perf_counter() - resolved
+            self.stats.time("construct", elapsed)
+            self.stats.page("/".join(path_elements), elapsed)
+
+    def build_response(self, file_path, path_elements, subpages, version, stream, blobs=False):
+        """Return the response for a page found in the index, see construct_page."""
+        if self.store is not None: # its archives are complete
+            return self.store.page(file_path, path_elements, subpages, version, stream)
+
+        try:
+            signature = page_signature(file_path)
+        except OSError: # removed since the index was updated
+            return frame(b"4" + path_field(path_elements))
+
+        if version == page_version(signature):
+            return frame(b"3" + path_field(path_elements) + subpages + version)
+        if blobs:
+            response = self.page_without_blobs(file_path, path_elements, signature, subpages)
+            if response is not None:
+                return response
+        response = self.cache.get(file_path, (signature, subpages)) # time stamps of subpages may have changed
+        self.stats.count("cache_misses" if response is None else "cache_hits")
+        if response is None:
+            if stream and sum(entry[3] for entry in signature if isinstance(entry, tuple) and not entry[1]) > self.stream_threshold:
+                return StreamedPage(b"0" + path_field(path_elements) + subpages + page_version(signature),
+                                    directory=file_path, compress_level=self.compress_level)
+            response = frame(*self.build_page(file_path, path_elements, signature, subpages))
+            self.cache.put(file_path, (signature, subpages), response)
+        if stream:
+            view = memoryview(response)
+            page_length = protocol.u32.unpack_from(view, 8)[0]
+            return StreamedPage(b"0" + view[12 + page_length:], archive=view[12:12 + page_length])
+        return response
+
+    def page_without_blobs(self, file_path, path_elements, signature, subpages):
+        """Return the response with status "2" for a page with its attachments of blob size left out, or None if it
+        has none or the rest is too large to be built in memory."""
+        files = {entry[0]: entry[2:] for entry in signature if isinstance(entry, tuple) and not entry[1]}
+        blobs = [name for name, status in files.items() if name not in page_files and self.blob_threshold <= status[1] <= self.stream_threshold]
+        if self.blob_threshold == 0 or not blobs or sum(files[name][1] for name in files if name not in blobs) > self.stream_threshold:
+            return None
+        key = (file_path, MessageType.QueryBlobs)
+        response = self.cache.get(key, (signature, subpages))
+        self.stats.count("cache_misses" if response is None else "cache_hits")
+        if response is None:
+            relative = "/".join(path_elements)
+            try:
+                references = [path_field([name]) + self.index.file_hash(relative, name, files[name]) + protocol.u64.pack(files[name][1]) for name in blobs]
+            except OSError: # changing meanwhile
+                return None
+            page = io.BytesIO()
+            build_archive(file_path, page, self.compress_level, set(files) - set(blobs))
+            page_view = page.getbuffer()
+            response = frame(b"2", protocol.u32.pack(len(page_view)), page_view, protocol.u16.pack(len(blobs)), *references,
+                             path_field(path_elements), subpages, page_version(signature))
+            self.cache.put(key, (signature, subpages), response)
+        self.stats.count("blobs_referenced", len(blobs))
+        return response
+
+    def send_blobs(self, path, requested):
+        """Return the framed response with the attachments of the page at path asked for, given as name -> hash."""
+        relative, path_elements = self.index.resolve(path.decode())
+        node = self.index.nodes.get(relative) if relative is not None else None
+        if node is None:
+            return frame(b"4" + path_field(path_elements))
+        parts = [b"0", b""]
+        size = 0
+        for name, digest in requested.items():
+            if size >= max_blobs_size or name not in node.files or name in page_files:
+                continue
+            record = self.blob(os.path.join(self.path, relative, name), digest)
+            if record is not None:
+                parts.append(record)
+                size += len(record)
+        parts[1] = protocol.u16.pack(len(parts) - 2)
+        self.stats.count("blobs_sent", len(parts) - 2)
+        return frame_parts(MessageType.Response, *parts)
+
+    def blob(self, file_path, digest):
+        """Return the record of an attachment in the answer to a blobs message, compressed once and then kept in the
+        cache by its hash, or None if the file does not have that content (any more)."""
+        record = self.cache.get(digest, digest)
+        if record is None:
+            try:
+                with open(file_path, "rb") as file:
+                    data = file.read(self.stream_threshold + 1)
+            except OSError:
+                return None
+            if hashlib.sha256(data).digest() != digest:
+                return None
+            if compress_type(file_path) == zipfile.ZIP_DEFLATED:
+                compressor = zlib.compressobj(self.compress_level, zlib.DEFLATED, -15)
+                record = protocol.blob_record(digest, 8, len(data), compressor.compress(data) + compressor.flush())
+            else:
+                record = protocol.blob_record(digest, 0, len(data), data)
+            self.cache.put(digest, digest, record)
+            self.stats.count("blobs_compressed")
+        return record
+
+    def construct_delta(self, path, version, held):
+        """Return the framed response with the files of the page at path which are not among those held,
+        given as name -> hash, and the names of those held which are gone; a StreamedPage if those files are large."""
+        file_path, path_elements = self.resolve(path)
+        relative = "/".join(path_elements)
+        subpages = self.index.subpages(relative) if file_path is not None else None
+        try:
+            signature = page_signature(file_path) if subpages is not None else None
+        except OSError: # removed since the index was updated
+            signature = None
+        if signature is None:
+            return frame(b"4" + path_field(path_elements))
+        current_version = page_version(signature)
+        if version == current_version:
+            return frame(b"3" + path_field(path_elements) + subpages + current_version)
+
+        files = {entry[0]: entry[2:] for entry in signature if isinstance(entry, tuple) and not entry[1]}
+        try:
+            changed = [name for name, status in files.items() if held.get(name) != self.index.file_hash(relative, name, status)]
+        except OSError: # changing meanwhile
+            return self.construct_page(path)
+        removed = [name for name in held if name not in files]
+        self.stats.count("delta_files_sent", len(changed))
+        self.stats.count("delta_files_kept", len(files) - len(changed))
+        if sum(files[name][1] for name in changed) > self.stream_threshold:
+            return StreamedPage(b"1" + names_field(removed) + path_field(path_elements) + subpages + current_version,
+                                directory=file_path, compress_level=self.compress_level, names=set(changed))
+        delta = io.BytesIO()
+        build_archive(file_path, delta, self.compress_level, set(changed))
+        delta_view = delta.getbuffer()
+        return frame_parts(MessageType.Response, b"1", protocol.u32.pack(len(delta_view)), delta_view, names_field(removed),
+                           path_field(path_elements), subpages, current_version)
+
+    def construct_bundle(self, path, depth, limit, held):
+        """Return a Bundle with the page at path and its subpages down to depth, or the response if there is no such
+        page; held gives the versions the client has as relative path -> version."""
+        relative, path_elements = self.index.resolve(path.decode())
+        if relative is None:
+            return frame(b"4" + path_field(path_elements))
+        limit = min(limit, max_bundle_size) if limit > 0 else max_bundle_size
+        return Bundle(b"0" + path_field(path_elements), self.bundle_pages(relative, depth, limit, held))
+
+    def bundle_pages(self, relative, depth, limit, held):
+        """Yield the responses to queries for the page and its subpages down to depth, breadth first, as they are sent.
+        Pages of streamed size and those which would pass the limit of bytes are left out."""
+        size = 0
+        pending = collections.deque([(relative, "", 0)])
+        while pending:
+            page_relative, name, level = pending.popleft()
+            node = self.index.nodes.get(page_relative)
+            if node is None: # removed meanwhile
+                continue
+            if level < depth:
+                for child in node.children:
+                    pending.append((page_relative + "/" + child if page_relative else child, name + "/" + child if name else child, level + 1))
+            subpages = self.index.subpages(page_relative)
+            if subpages is None or node.size > self.stream_threshold:
+                self.stats.count("bundle_pages_left_out")
+                continue
+            started = time.perf_counter()
+            path_elements = page_relative.split("/") if page_relative else []
+            response = self.build_response(os.path.join(self.path, *path_elements), path_elements, subpages, held.get(name), False, True)
+            elapsed = time.perf_counter() - started
+            self.stats.time("construct", elapsed)
+            self.stats.page(page_relative, elapsed)
+            page_size = response_size(response)
+            if size + page_size > limit or response_status(response) == b"4":
+                if not isinstance(response, bytes):
+                    response.file.close()
+                self.stats.count("bundle_pages_left_out")
+                continue
+            size += page_size
+            self.stats.count("bundle_pages")
+            yield response
+
+    def search_pages(self, words, limit):
+        if self.search is None:
+            return frame(b"4" + path_field([]))
+        results = self.search.search(words, limit)
+        parts = [b"0", protocol.u16.pack(len(results))]
+        for relative, score, snippet in results:
+            parts += [path_field(relative.split("/") if relative else []), protocol.u32.pack(min(int(score * 1000), 0xFFFFFFFF)),
+                      protocol.field(bytes(snippet, "utf-8"))]
+        return frame_parts(MessageType.Response, *parts)
+
+    def list_pages(self, path, depth):
+        relative, path_elements = self.index.resolve(path.decode())
+        if relative is None:
+            return frame(b"4" + path_field(path_elements))
+        try:
+            return frame_parts(MessageType.Response, b"0", path_field(path_elements), self.index.list_pages(relative, depth))
+        except (OSError, KeyError): # changed while listing
+            return frame(b"4" + path_field(path_elements))
+
+    def build_page(self, file_path, path_elements, signature, subpages):
+        """Return the parts of the response with the page, to be framed."""
+        page = io.BytesIO()
+        build_archive(file_path, page, self.compress_level)
+        page_view = page.getbuffer()
+        return b"0", protocol.u32.pack(len(page_view)), page_view, path_field(path_elements), subpages, page_version(signature)
+
+
+class AsyncServer(Server):
+    """Serves all sessions from one event loop; disk reads and zipping go to a bounded thread pool."""
+
+    def __init__(self, connections=default_connections, workers=default_workers, **options):
+        Server.__init__(self, **options)
+        self.connections = connections
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        self.tasks = set() # of the sessions
+        self.idle = set() # writers of the sessions waiting for a query
+
+    def run(self):
+        asyncio.run(self.serve())
+        self.executor.shutdown()
+        if self.halt is None:
+            print("Server halted.")
+
+    def stop(self):
+        self.up = False
+        if self.halt is not None:
+            self.halt.set()
+        self.stopped.set()
+
+    async def serve(self):
+        self.limit = asyncio.Semaphore(self.connections)
+        self.stopped = asyncio.Event()
+        listener = await asyncio.start_server(self.handle, sock=self.socket, backlog=self.backlog)
+        async with listener:
+            if self.halt is None:
+                await self.stopped.wait()
+            else:
+                while not self.stopped.is_set() and not self.halt.is_set():
+                    try:
+                        await asyncio.wait_for(self.stopped.wait(), halt_poll_interval)
+                    except asyncio.TimeoutError:
+                        pass
+            self.up = False
+            listener.close()
+            await self.finish()
+
+    async def finish(self):
+        """See Server.finish"""
+        for writer in self.idle:
+            writer.close()
+        if self.tasks:
+            await asyncio.wait(self.tasks, timeout=shutdown_timeout)
+
+    async def receive(self, reader, persistent):
+        """See Session.receive"""
+        async def rest(first):
+            length = protocol.length_field.unpack(first + await reader.readexactly(3))[0]
+            if length > max_query_size:
+                raise ValueError("Message of {} bytes too long".format(length))
+            return await reader.readexactly(length)
+
+        try:
+            first = await asyncio.wait_for(reader.readexactly(1), self.idle_timeout if persistent else self.read_timeout)
+        except asyncio.TimeoutError:
+            if persistent:
+                return None
+            raise
+        except (asyncio.IncompleteReadError, ConnectionError):
+            return None
+        try:
+            return await asyncio.wait_for(rest(first), self.read_timeout)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            return None
+
+    async def discard(self, reader):
+        while await reader.read(stream_chunk_size):
+            pass
+
+    async def send(self, writer, response):
+        deadline = WriteDeadline(self.write_timeout)
+        if isinstance(response, bytes):
+            await write_data(writer, response, deadline)
+        elif isinstance(response, list):
+            writer.writelines(response)
+            await asyncio.wait_for(writer.drain(), deadline.extend(response_size(response)))
+        else:
+            await response.write(writer, self.executor, deadline)
+            await asyncio.wait_for(writer.drain(), deadline.extend(0))
+
+    async def handle(self, reader, writer):
+        address = writer.get_extra_info("peername")
+        if not self.admit(address):
+            self.stats.count("sessions_rejected")
+            writer.write(frame(b"5"))
+            try: # let the client read the answer and close first, closing with its query unread would reset the connection
+                writer.write_eof()
+                await asyncio.wait_for(self.discard(reader), reject_linger)
+            except (asyncio.TimeoutError, ConnectionError):
+                pass
+            writer.close()
+            return
+        self.tasks.add(asyncio.current_task())
+        try:
+            async with self.limit:
+                await self.serve_session(reader, writer)
+        finally:
+            self.release(address)
+            self.tasks.discard(asyncio.current_task())
+
+    async def serve_session(self, reader, writer):
+        persistent = False
+        self.stats.count("sessions_opened")
+        try:
+            while self.up:
+                self.idle.add(writer)
+                try:
+                    query = await self.receive(reader, persistent)
+                finally:
+                    self.idle.discard(writer)
+                if query is None:
+                    break
+                if len(query) < 3 or query[:2] != identifier:
+                    address = writer.get_extra_info("peername")
+                    print("Invalid connection request from address: " + address[0] + ", port: " + str(address[1]))
+                    break
+
+                if query[2:3] == MessageType.ShutDown:
+                    self.stop()
+                    break
+
+                if query[2:3] == MessageType.KeepAlive:
+                    persistent = True
+                    await self.send(writer, self.keep_alive())
+                elif query[2:3] == MessageType.Stats:
+                    await self.send(writer, self.stats_response())
+                else:
+                    loop = asyncio.get_running_loop()
+                    response = await loop.run_in_executor(self.executor, self.respond, query)
+                    started = time.perf_counter()
+                    await self.send(writer, response)
+                    self.sent(response, started)
+                if not persistent:
+                    break
+        except (asyncio.TimeoutError, socket.timeout):
+            self.stats.count("timeouts")
+        except (ConnectionError, ValueError):
+            self.stats.count("connection_errors")
+        finally:
+            writer.close()
+            self.stats.count("sessions_closed")
+
+
+class Prefork(object):
+    """Runs a server in several processes which accept connections from one listening socket, so that zipping uses
+    all cores. Each process gets its share of the cache size; the store is built and kept up to date here only.
+    A shut down message to any of the processes stops them all."""
+
+    def __init__(self, processes, create=Server, host=default_host, port=default_port, backlog=default_backlog,
+                 cache_size=default_cache_size, site_path=default_site_path, store_path=None,
+                 rebuild_interval=default_rebuild_interval, compress_level=default_compress_level,
+                 index_interval=default_index_interval, stat_interval=default_stat_interval, search_path="", **options):
+        context = multiprocessing.get_context("fork") # the processes inherit the socket
+        self.socket = listen(host, port, backlog)
+        self.halt = context.Event()
+        self.store = None
+        if store_path is not None:
+            self.store = Store(site_path, store_path, compress_level)
+            print("Built {} page(s).".format(self.store.update()))
+        self.index = None
+        if search_path == "":
+            search_path = search_index_path(site_path)
+        if search_path is not None: # the processes read the search index from the file written here
+            self.index = SiteIndex(os.path.realpath(site_path), stat_interval)
+            self.search = search.SearchIndex(self.index, search_path)
+            print("Indexed {} page(s) for search.".format(self.search.update()))
+        options.update(cache_size=cache_size // processes, site_path=site_path, store_path=store_path,
+                       compress_level=compress_level, index_interval=index_interval, stat_interval=stat_interval, search_path=search_path,
+                       listener=self.socket, halt=self.halt)
+        self.processes = [context.Process(target=self.serve, args=(create, options), daemon=True) for index in range(processes)]
+        self.rebuild_interval = rebuild_interval
+        self.index_interval = index_interval
+        print("Markdown Page server running on host '{}', port {} in {} processes.".format(host, port, processes))
+
+    def serve(self, create, options):
+        try:
+            create(**options).run()
+        except KeyboardInterrupt:
+            pass
+
+    def run(self):
+        for process in self.processes:
+            process.start()
+        if self.store is not None: # only after forking, so no process inherits the lock of a build in progress
+            Updater(self.store, self.rebuild_interval, "Rebuilt {} page(s).").start()
+        if self.index is not None:
+            Updater(self.index, self.index_interval, "Reindexed {} directories.").start()
+            Updater(self.search, self.index_interval, "Indexed {} page(s) for search.").start()
+        try:
+            while not self.halt.wait(halt_poll_interval):
+                if not any(process.is_alive() for process in self.processes):
+                    break
+        except KeyboardInterrupt:
+            self.halt.set()
+        for process in self.processes:
+            process.join()
+        self.socket.close()
+        print("Server halted.")
+
 
 class Session(threading.Thread):
     def __init__(self, socket, address, server):
-        threading.Thread.__init__(self)
+        threading.Thread.__init__(self, daemon=True)
         self.socket = socket
         self.address = address
         self.server = server
         #self.up = True
 
-    def send(self, data):
-        length = len(data)
-        self.socket.send(length.to_bytes(4, byteorder="big"))
-        self.socket.sendall(data)
-
-    def receive(self):
-        length_bytes = self.socket.recv(4)
-        if len(length_bytes) != 4:
-            return None
-
-        length = int.from_bytes(length_bytes, byteorder="big")
-        data = bytearray(length)
-        view = memoryview(data)
-        next_offset = 0
-        while length - next_offset > 0:
-            recv_size = self.socket.recv_into(view[next_offset:], length - next_offset)
-            if recv_size == 0:
+    def receive(self, persistent):
+        """Wait for the next query to begin, up to the idle timeout on a kept alive connection, then up to the read
+        timeout for all of it; return None if the connection is closed or has been idle long enough."""
+        self.socket.settimeout(self.server.idle_timeout if persistent else self.server.read_timeout)
+        try:
+            if not self.socket.recv(1, socket.MSG_PEEK):
                 return None
-            next_offset += recv_size
-        return data
+        except socket.timeout:
+            if persistent:
+                return None
+            raise
+        return protocol.receive_message(self.socket, deadline=time.monotonic() + self.server.read_timeout, limit=max_query_size)
+
+    def send(self, response):
+        deadline = WriteDeadline(self.server.write_timeout)
+        if isinstance(response, bytes):
+            send_data(self.socket, response, deadline)
+        elif isinstance(response, list): # not cached, header and parts go out in one scatter-gather call
+            remaining = deadline.extend(response_size(response))
+            protocol.send_buffers(self.socket, response, deadline=time.monotonic() + remaining)
+        else:
+            response.send(self.socket, deadline)
 
     def run(self):
-        query = self.receive()
-        if len(query) < 3 or query[:2] != identifier:
-            print("Invalid connection request from address: " + self.address[0] + ", port: " + str(self.address[1]))
+        self.server.stats.count("sessions_opened")
+        try:
+            self.serve()
+        except socket.timeout:
+            self.server.stats.count("timeouts")
+        except (OSError, ValueError): # connection reset or query too long
+            self.server.stats.count("connection_errors")
+        finally:
             self.socket.close()
-            return
+            self.server.release(self.address)
+            self.server.stats.count("sessions_closed")
 
-        if query[2:3] == MessageType.ShutDown:
-            self.server.up = False
-            self.socket.close()
-            return
+    def serve(self):
+        persistent = False
+        while True:
+            query = self.receive(persistent)
+            if query is None:
+                break
+            if len(query) < 3 or query[:2] != identifier:
+                print("Invalid connection request from address: " + self.address[0] + ", port: " + str(self.address[1]))
+                break
 
-        page = self.construct_page(query[5:])
+            if query[2:3] == MessageType.ShutDown:
+                self.socket.close()
+                self.server.stop()
+                return
 
-        self.send(bytes([0x06, 0x0E, 255]) + page)
-        self.socket.close()
+            if query[2:3] == MessageType.KeepAlive:
+                persistent = True
+                self.send(self.server.keep_alive())
+                continue
 
-    def construct_page(self, path):
-        file_path = self.server.path
-        found = False
-        path_elements = []
-        if path == b"":
-            found = True
-        else:
-            path_list = path.decode().split("/")
-            for directory in path_list:
-                if directory == "":
-                    continue
-                found = False
-                with os.scandir(file_path) as iterator:
-                    for entry in iterator:
-                        if entry.is_dir() and entry.name == directory:
-                            file_path = os.path.join(file_path, entry.name)
-                            path_elements.append(entry.name)
-                            found = True
-                            break
-                if not found:
-                    with os.scandir(file_path) as iterator:
-                        for entry in iterator:
-                            if entry.is_dir() and entry.name.casefold() == directory.casefold():  # Make lookup path case insensitive
-                                file_path = os.path.join(file_path, entry.name)
-                                path_elements.append(entry.name)
-                                found = True
-                                break
-                if not found:
-                    path_elements.append(directory)
-                    break
+            if query[2:3] == MessageType.Stats:
+                self.send(self.server.stats_response())
+            else:
+                response = self.server.respond(query)
+                started = time.perf_counter()
+                self.send(response)
+                self.server.sent(response, started)
+            if not persistent:
+                break
 
-        if not found:
-            path_bytes = bytes("/".join(path_elements), "utf-8")
-            return b"4" + len(path_bytes).to_bytes(2, byteorder="big") + path_bytes
 
-        page = io.BytesIO()
-        subpages = b""
-        subpages_count = 0
-        with zipfile.ZipFile(page, "a", zipfile.ZIP_DEFLATED) as zip_file:
-            with os.scandir(file_path) as iterator:
-                for entry in iterator:
-                    if entry.is_file():
-                        zip_file.write(os.path.join(file_path, entry.name), entry.name)
-                    if entry.is_dir():
-                        entry_bytes = bytes(entry.name, "utf-8")
-                        subpages += len(entry_bytes).to_bytes(2, byteorder="big") + entry_bytes + bytes([0, 0, 0, 0]) # last 4 bytes placeholder for time stamp in Julian minutes
-                        subpages_count += 1
-        page_str = page.getvalue()
-        path_bytes = bytes("/".join(path_elements), "utf-8")
-        return b"0" + len(page_str).to_bytes(4, byteorder="big") + page_str + len(path_bytes).to_bytes(2, byteorder="big") + path_bytes + subpages_count.to_bytes(2, byteorder="big") + subpages
-
-server = Server()
-server.run()
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Server for Markdown Pages")
+    parser.add_argument("--host", default=default_host)
+    parser.add_argument("--port", type=int, default=default_port)
+    parser.add_argument("--site", default=default_site_path, help="directory with the pages to publish")
+    parser.add_argument("--index-interval", type=float, default=default_index_interval, help="seconds between scans of the site for changes")
+    parser.add_argument("--stat-interval", type=float, default=default_stat_interval, help="seconds between checks of all files for changes made in place")
+    parser.add_argument("--search-index", default="", help="file to keep the full-text search index in, by default one for each site next to server.py")
+    parser.add_argument("--no-search", action="store_true", help="do not index the site for search")
+    parser.add_argument("--store", help="serve prebuilt archives from this directory (see build.py) and keep them up to date")
+    parser.add_argument("--rebuild-interval", type=float, default=default_rebuild_interval, help="seconds between checks for changes to rebuild")
+    parser.add_argument("--compress-level", type=int, default=default_compress_level, choices=range(10), help="zlib level for text and other compressible files")
+    parser.add_argument("--stream-threshold", type=int, default=default_stream_threshold, help="bytes of files from which streamed pages are not built in memory")
+    parser.add_argument("--blob-threshold", type=int, default=default_blob_threshold, help="bytes of an attachment from which it is sent by hash, 0 for never")
+    parser.add_argument("--cache-size", type=int, default=default_cache_size, help="bytes of built pages kept in memory")
+    parser.add_argument("--backlog", type=int, default=default_backlog, help="pending connections queued by the operating system")
+    parser.add_argument("--idle-timeout", type=int, default=default_idle_timeout, help="seconds a kept alive connection may stay idle")
+    parser.add_argument("--read-timeout", type=float, default=default_read_timeout, help="seconds a client may take to send a query")
+    parser.add_argument("--write-timeout", type=float, default=default_write_timeout, help="seconds a client may take to accept a response, beyond the time its bytes take at %d bytes per second" % min_write_rate)
+    parser.add_argument("--max-sessions", type=int, default=default_max_sessions, help="sessions served at once (in each process), more connections are answered busy")
+    parser.add_argument("--max-sessions-per-address", type=int, default=default_max_sessions_per_address, help="sessions of one client address served at once")
+    parser.add_argument("--asyncio", action="store_true", help="serve from an event loop instead of one thread per connection")
+    parser.add_argument("--connections", type=int, default=default_connections, help="sessions served at once (asyncio mode)")
+    parser.add_argument("--workers", type=int, default=default_workers, help="threads building pages (asyncio mode)")
+    parser.add_argument("--processes", type=int, default=default_processes, help="processes serving connections, each with a share of the cache size")
+    parser.add_argument("--stats-log", help="file to append the statistics to as JSON lines")
+    parser.add_argument("--stats-interval", type=float, default=default_stats_interval, help="seconds between lines of the statistics log")
+    arguments = parser.parse_args()
+    if arguments.processes > 1 and "fork" not in multiprocessing.get_all_start_methods():
+        parser.error("--processes needs an operating system which can fork")
+
+    options = dict(host=arguments.host, port=arguments.port, cache_size=arguments.cache_size, backlog=arguments.backlog,
+                   idle_timeout=arguments.idle_timeout, site_path=arguments.site, store_path=arguments.store,
+                   rebuild_interval=arguments.rebuild_interval, compress_level=arguments.compress_level,
+                   index_interval=arguments.index_interval, stat_interval=arguments.stat_interval, stream_threshold=arguments.stream_threshold,
+                   stats_log=arguments.stats_log, stats_interval=arguments.stats_interval,
+                   search_path=None if arguments.no_search else arguments.search_index,
+                   read_timeout=arguments.read_timeout, write_timeout=arguments.write_timeout, max_sessions=arguments.max_sessions,
+                   max_sessions_per_address=arguments.max_sessions_per_address, blob_threshold=arguments.blob_threshold)
+    if arguments.processes > 1:
+        create = (lambda **options: AsyncServer(arguments.connections, arguments.workers, **options)) if arguments.asyncio else Server
+        server = Prefork(arguments.processes, create, **options)
+    elif arguments.asyncio:
+        server = AsyncServer(arguments.connections, arguments.workers, **options)
+    else:
+        server = Server(**options)
+    server.run()